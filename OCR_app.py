@@ -1,25 +1,55 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Header
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Query
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 import uvicorn
-import io, os
+import os
+import threading
+from contextlib import asynccontextmanager
+from datetime import date
 import logging
 from dotenv import load_dotenv
-from PIL import Image
 
-# Import vision parser (the good one!)
-from parser import parse_receipt_image
-from gsheet import append_to_sheet
+from logging_setup import configure_logging
 
 load_dotenv()
 
+# Configure logging before the parser/sheets modules log their setup
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Import vision parser (the good one!)
+from parser import budget, parse_receipt_image, result_cache, store_cache, usage_ledger, vision_guard
+from gsheet import append_to_sheet, flush_write_buffer, receipt_store, run_write_buffer_flusher, write_buffer
+from gsheet import item_index, run_item_index_saver
+from resilience import VisionUnavailableError
+from usage import BudgetExceededError
+from image_format import HEIF_SUPPORTED, ImageTooLargeError, open_image, sniff_format
+
 SYSTEM_API_KEY = os.getenv("system_API")
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Uploads are read fully into memory once; bound what one request can hold
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Per-worker background flushers for the shared sheet write buffer and the item index"""
+    stop = threading.Event()
+    if write_buffer is not None:
+        threading.Thread(target=run_write_buffer_flusher, args=(stop,), daemon=True).start()
+    threading.Thread(target=run_item_index_saver, args=(stop,), daemon=True).start()
+    yield
+    stop.set()
+    item_index.save_if_changed()
+    if write_buffer is not None:
+        try:
+            flush_write_buffer()
+        except Exception as e:
+            logger.warning("⚠️ Final sheet flush failed, rows stay buffered: %s", e)
+
 
-app = FastAPI(title="Receipt OCR API", version="3.0")
+app = FastAPI(title="Receipt OCR API", version="3.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,14 +68,92 @@ async def root():
         "method": "Claude Vision API",
         "endpoints": {
             "POST /receipt": "Process receipt image (Vision + AI + Sheets)",
+            "GET /metrics": "Vision API limiter, circuit breaker and store-template stats",
+            "GET /receipts": "List processed receipts (?store=&from=&to=&limit=&offset=)",
+            "GET /spend": "Spend totals by store and day (?store=&from=&to=)",
+            "GET /usage": "Vision token/cost usage by day and client (?client=&from=&to=)",
             "GET /": "Health check"
         }
     }
 
+
+@app.get("/metrics")
+async def metrics():
+    """Runtime metrics for dashboards"""
+    return {
+        "worker_pid": os.getpid(),
+        "vision_api": vision_guard.snapshot(),
+        "store_templates": store_cache.snapshot(),
+        "result_cache": result_cache.snapshot() if result_cache else None,
+        "sheet_write_buffer": write_buffer.snapshot() if write_buffer else None,
+        "budget": budget.snapshot(),
+    }
+
+
+@app.get("/usage")
+def usage(
+    client: str | None = None,
+    from_: date | None = Query(None, alias="from"),
+    to: date | None = None,
+):
+    """Token, cost and wall-time totals per day and per client"""
+    return {
+        "client": client,
+        "from": from_.isoformat() if from_ else None,
+        "to": to.isoformat() if to else None,
+        **usage_ledger.summary(
+            date_from=from_.isoformat() if from_ else None,
+            date_to=to.isoformat() if to else None,
+            client=client,
+        ),
+        "budget": budget.snapshot(),
+    }
+
+
+@app.get("/receipts")
+def list_receipts(
+    store: str | None = None,
+    from_: date | None = Query(None, alias="from"),
+    to: date | None = None,
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+):
+    """Processed receipts from the local store (no Sheets API reads)"""
+    receipts = receipt_store.list_receipts(
+        store=store,
+        date_from=from_.isoformat() if from_ else None,
+        date_to=to.isoformat() if to else None,
+        limit=limit,
+        offset=offset,
+    )
+    return {"count": len(receipts), "receipts": receipts}
+
+
+@app.get("/spend")
+def spend(
+    store: str | None = None,
+    from_: date | None = Query(None, alias="from"),
+    to: date | None = None,
+):
+    """Spend totals from the precomputed per-day/per-store aggregates"""
+    result = receipt_store.spend(
+        store=store,
+        date_from=from_.isoformat() if from_ else None,
+        date_to=to.isoformat() if to else None,
+    )
+    return {
+        "store": store,
+        "from": from_.isoformat() if from_ else None,
+        "to": to.isoformat() if to else None,
+        **result,
+    }
+
+
 @app.post("/receipt")
 async def process_receipt(
     file: UploadFile = File(...),
-    authorization: str | None = Header(None)
+    authorization: str | None = Header(None),
+    x_client_id: str | None = Header(None),
 ):
     """
     Process a receipt image using Claude Vision API:
@@ -58,27 +166,40 @@ async def process_receipt(
     #     raise HTTPException(status_code=401, detail="Unauthorized")
     
     try: 
-        # Validate file type
-        if not file.content_type or not file.content_type.startswith('image/'):
+        # Validate file type (some iOS clients send HEIC as octet-stream)
+        if not file.content_type or not (
+            file.content_type.startswith('image/') or file.content_type == 'application/octet-stream'
+        ):
             raise HTTPException(
                 status_code=400,
                 detail="File must be an image!"
             )
         
-        logger.info(f"📸 Processing receipt: {file.filename}")
+        logger.info("📸 Processing receipt: %s", file.filename)
         
-        # Read image bytes
-        image_bytes = await file.read()
+        if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Image larger than {MAX_UPLOAD_BYTES // 1024 // 1024} MB")
+        
+        # Read image bytes - the only copy of the upload; everything downstream shares it
+        image_bytes = await file.read(MAX_UPLOAD_BYTES + 1)
+        await file.close()
         
         if len(image_bytes) == 0:
             raise HTTPException(status_code=400, detail="Empty file received.")
+        if len(image_bytes) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Image larger than {MAX_UPLOAD_BYTES // 1024 // 1024} MB")
+        
+        # The declared content type is not trusted; the bytes decide the format
+        if sniff_format(image_bytes) == "heic" and not HEIF_SUPPORTED:
+            raise HTTPException(status_code=415, detail="HEIC images need pillow-heif on the server; send JPEG or PNG")
         
-        # Verify it's a valid image
+        # Verify it's a valid image (BytesIO over bytes shares the buffer, no copy)
         try:
-            image_stream = io.BytesIO(image_bytes)
-            image = Image.open(image_stream)
+            image = open_image(image_bytes)
             image.verify()
             logger.info("✓ Image validated")
+        except ImageTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
         except Exception as e:
             raise HTTPException(
                 status_code=400,
@@ -86,35 +207,42 @@ async def process_receipt(
             )
         
         # Parse with Claude Vision - IMPORTANT: Pass image_bytes!
+        # Blocking calls run in the threadpool so requests can overlap
         logger.info("🤖 Analyzing receipt with Claude Vision...")
-        parsed = parse_receipt_image(image_bytes)
+        receipt = await run_in_threadpool(parse_receipt_image, image_bytes, client=x_client_id or "default")
         
         # Append to Google Sheets
         logger.info("📊 Appending to Google Sheets...")
-        sheet_result = append_to_sheet(parsed)
+        sheet_result = await run_in_threadpool(append_to_sheet, receipt)
         
         return JSONResponse({
             "status": "success",
             "message": "Receipt processed successfully",
-            "data": {
-                "receipt_id": parsed.get("receipt_id"),
-                "store_name": parsed.get("store_name"),
-                "date": parsed.get("date"),
-                "total": parsed.get("total"),
-                "payment_method": parsed.get("payment_method"),
-                "card_last_4": parsed.get("card_last_4"),
-                "item_count": len(parsed.get("items", [])),
-            },
+            "data": receipt.to_summary(),
             "sheet_update": {
                 "rows_added": sheet_result.get("updates", {}).get("updatedRows", 0),
-                "cells_updated": sheet_result.get("updates", {}).get("updatedCells", 0)
+                "cells_updated": sheet_result.get("updates", {}).get("updatedCells", 0),
+                "buffered": sheet_result.get("buffered", False),
             }
         })
         
     except HTTPException:
         raise
+    except BudgetExceededError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after) or 1)},
+        )
+    except VisionUnavailableError as e:
+        # Nothing is written to the sheet; the client should retry later
+        raise HTTPException(
+            status_code=503,
+            detail=f"Receipt service temporarily unavailable: {e}",
+            headers={"Retry-After": str(int(e.retry_after) or 1)},
+        )
     except Exception as e:
-        logger.error(f"❌ Error processing receipt: {str(e)}", exc_info=True)
+        logger.error("❌ Error processing receipt: %s", e, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
@@ -122,9 +250,15 @@ async def process_receipt(
 
 
 if __name__ == "__main__":
+    # APP_ENV=production runs WEB_WORKERS processes; development keeps auto-reload
+    workers = int(os.getenv("WEB_WORKERS", "1"))
+    production = os.getenv("APP_ENV", "development") == "production"
     uvicorn.run(
         "OCR_app:app", 
         host="0.0.0.0",  # Allow external connections (for iPhone)
-        port=8000, 
-        reload=True
+        port=int(os.getenv("PORT", "8000")),
+        reload=not production,
+        workers=workers if production else 1,
+        loop="uvloop",
+        http="httptools",
     )
\ No newline at end of file
@@ -0,0 +1,758 @@
+"""
+Micro-benchmarks for the receipt pipeline
+
+Usage:
+  python benchmark.py validation [n_receipts]
+  python benchmark.py models [n_receipts]
+  python benchmark.py logging [n_requests]
+  python benchmark.py store_templates [n_images]
+  python benchmark.py item_index [n_names]
+  python benchmark.py receipt_store [n_receipts]
+  python benchmark.py sheet_import [n_receipts]
+  python benchmark.py sheet_import_check
+  python benchmark.py image_pipeline [megapixels]
+  python benchmark.py formats [n_receipts]
+"""
+import base64
+import contextlib
+import copy
+import gc
+import io
+import random
+import sys
+import time
+import tracemalloc
+from typing import Dict, List
+
+import validation
+from models import Receipt
+
+
+def make_receipts(n: int, seed: int = 0) -> List[Dict]:
+    """Synthetic parsed receipts shaped like the vision model output"""
+    rng = random.Random(seed)
+    receipts = []
+    for idx in range(n):
+        items = []
+        for i in range(rng.randint(5, 60)):
+            qty = rng.choice([1, 1, 1, 2, 3])
+            unit = round(rng.uniform(0.5, 25), 2)
+            items.append({
+                "name": f"ITEM {i} {rng.randint(10, 999)}G",
+                "quantity": qty,
+                "unit_price": unit if rng.random() > 0.2 else 0,
+                "line_total": round(unit * qty, 2),
+                "category": "product",
+            })
+        items.append({"name": "BAG FEE", "quantity": 4, "unit_price": 0.10, "line_total": 0.40, "category": "fee"})
+        items.append({"name": "TAX", "quantity": 1, "unit_price": 0, "line_total": 1.23, "category": "tax"})
+        total = round(sum(i["line_total"] for i in items), 2)
+        receipts.append({
+            "receipt_id": str(idx),
+            "store_name": "TRADER JOE'S",
+            "date": "2025-12-15",
+            "total": total if rng.random() > 0.1 else total + 5,
+            "items": items,
+        })
+    return receipts
+
+
+def legacy_validate(data: Dict) -> Dict:
+    """The pre-vectorization loop-based validation, without the prints"""
+    valid_items = []
+    total_from_items = 0.0
+    for item in data["items"]:
+        if not item.get("name"):
+            continue
+        quantity = item.get("quantity", 1)
+        line_total = item.get("line_total", 0.0)
+        category = item.get("category", "product")
+        if not item.get("unit_price") or item.get("unit_price") == 0:
+            item["unit_price"] = round(line_total / quantity, 2) if quantity > 0 else line_total
+        item["quantity"] = int(quantity)
+        item["unit_price"] = float(item["unit_price"])
+        item["line_total"] = float(line_total)
+        item["category"] = category
+        valid_items.append(item)
+        total_from_items += line_total
+    data["items"] = valid_items
+    data["item_count"] = len(valid_items)
+    data["_mismatch"] = abs(total_from_items - float(data.get("total", 0))) > 0.10
+    tax_items = [i for i in valid_items if i.get("category") == "tax"]
+    fee_items = [i for i in valid_items if i.get("category") in ["fee", "deposit"]]
+    product_items = [i for i in valid_items if i.get("category") == "product"]
+    sum(i["line_total"] for i in tax_items)
+    sum(i["line_total"] for i in fee_items)
+    sum(i["line_total"] for i in product_items)
+    return data
+
+
+def timed(fn, make_input, repeat: int = 5) -> float:
+    """Best wall time of fn over fresh inputs, with the GC paused"""
+    best = float("inf")
+    for _ in range(repeat):
+        args = make_input()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            fn(args)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+def check_validation_engines(n: int = 2_000):
+    """validate_receipt (per request) and validate_batch/validate_items (bulk) must agree exactly"""
+    rng = random.Random(7)
+    receipts = make_receipts(n, seed=7)
+    for data in receipts:
+        # Weighted lines with sub-cent amounts, as the prompt's "0.58 lb @ $1.99/lb" example produces
+        for _ in range(rng.randint(0, 3)):
+            data["items"].append({"name": "GRAPES RED", "quantity": 1, "unit_price": 0,
+                                  "line_total": round(rng.uniform(0.5, 5), 4), "category": "product"})
+        if rng.random() < 0.05:
+            data["items"][0]["quantity"] = rng.choice(["two", "", None, "3"])
+    singles, bulk = copy.deepcopy(receipts), copy.deepcopy(receipts)
+    breakdowns = [validation.validate_receipt(data) for data in singles]
+    summary = validation.validate_items(bulk)
+    for idx, (single, data) in enumerate(zip(breakdowns, bulk)):
+        assert single == {**summary.breakdown(idx), "mismatch": bool(summary.mismatch[idx])}, idx
+        assert singles[idx]["items"] == data["items"], idx
+    return n
+
+
+def bench_validation(n: int = 10_000):
+    """Loop-per-receipt validation vs one vectorized batch"""
+    checked = check_validation_engines()
+    receipts = lambda: make_receipts(n)
+    legacy = timed(lambda rs: [legacy_validate(r) for r in rs], receipts)
+    per_receipt = timed(lambda rs: [validation.validate_receipt(r) for r in rs], receipts)
+    batched = timed(validation.validate_batch, receipts)
+    in_place = timed(validation.validate_items, receipts)
+    one = timed(lambda rs: [validation.validate_batch([r]) for r in rs], receipts)
+
+    def with_bad_values():
+        rs = make_receipts(n)
+        rs[len(rs) // 2]["items"][0]["quantity"] = "two"
+        return rs
+
+    bad = timed(validation.validate_batch, with_bad_values)
+    print(f"validation on {n} receipts (per-request and bulk engines agree on {checked} receipts):")
+    print(f"   legacy loops:                {legacy * 1000:8.1f} ms")
+    print(f"   validate_receipt (per req):  {per_receipt * 1000:8.1f} ms   {legacy / per_receipt:5.2f}x"
+          f"   {per_receipt / n * 1e6:6.1f} us/receipt")
+    print(f"   validate_batch of one:       {one * 1000:8.1f} ms   {legacy / one:5.2f}x"
+          f"   {one / n * 1e6:6.1f} us/receipt")
+    print(f"   validate_batch (arrays):     {batched * 1000:8.1f} ms   {legacy / batched:5.2f}x")
+    print(f"   validate_batch, one bad qty: {bad * 1000:8.1f} ms   {legacy / bad:5.2f}x")
+    print(f"   validate_items (write-back): {in_place * 1000:8.1f} ms   {legacy / in_place:5.2f}x")
+
+
+def retained_bytes(build) -> int:
+    """Bytes still allocated after build() returns (its result is kept alive)"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_models(n: int = 10_000):
+    """Memory and conversion cost of Receipt/LineItem vs nested dicts"""
+    import gsheet
+
+    receipts = make_receipts(n)
+    validation.validate_items(receipts)
+
+    dict_bytes = retained_bytes(lambda: copy.deepcopy(receipts))
+    model_bytes = retained_bytes(lambda: [Receipt.from_dict(r) for r in receipts])
+    models = [Receipt.from_dict(r) for r in receipts]
+
+    from_dict = timed(lambda rs: [Receipt.from_dict(r) for r in rs], lambda: receipts)
+    to_dict = timed(lambda ms: [m.to_dict() for m in ms], lambda: models)
+    summary = timed(lambda ms: [m.to_summary() for m in ms], lambda: models)
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = timed(lambda ms: [gsheet.build_sheet_rows(m, "2025-12-15 00:00:00") for m in ms], lambda: models)
+
+    print(f"receipt model on {n} receipts:")
+    print(f"   memory as dicts:     {dict_bytes / 1024 / 1024:8.1f} MB")
+    print(f"   memory as Receipt:   {model_bytes / 1024 / 1024:8.1f} MB   ({model_bytes / dict_bytes:.0%})")
+    print(f"   Receipt.from_dict:   {from_dict * 1000:8.1f} ms")
+    print(f"   Receipt.to_dict:     {to_dict * 1000:8.1f} ms")
+    print(f"   Receipt.to_summary:  {summary * 1000:8.1f} ms")
+    print(f"   build_sheet_rows:    {rows * 1000:8.1f} ms")
+
+
+def bench_logging(n: int = 2_000):
+    """Per-request CPU of the logging around validation, summary and sheet rows"""
+    import gsheet
+    import parser
+    from logging_setup import configure_logging
+
+    def run(receipts):
+        for data in receipts:
+            receipt = Receipt.from_dict(parser.validate_and_enrich_v2(data))
+            parser.display_parsing_summary_v2(receipt)
+            gsheet.build_sheet_rows(receipt, "2025-12-15 00:00:00")
+
+    results = {}
+    for level in ("DEBUG", "INFO"):
+        sink = io.StringIO()
+        configure_logging(level=level, stream=sink)
+        start = time.process_time()
+        run(make_receipts(n))
+        results[level] = (time.process_time() - start, len(sink.getvalue()))
+
+    print(f"logging overhead over {n} requests:")
+    for level, (cpu, size) in results.items():
+        print(f"   {level:<6} {cpu / n * 1e6:8.1f} µs CPU/request   {size / n / 1024:6.1f} KB log/request")
+    saved = results["DEBUG"][0] - results["INFO"][0]
+    print(f"   saved at INFO: {saved / n * 1e6:.1f} µs CPU/request")
+
+
+def make_receipt_image(seed: int, header: str, n_lines: int = 40, width: int = 1200, logo: bool = True,
+                       address: str = "") -> bytes:
+    """Synthetic receipt photo: optional logo block, centred store header, item lines"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    rng = random.Random(seed)
+    height = 260 + n_lines * 40
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    if logo:
+        draw.rectangle((width // 5, 20, width * 4 // 5, 120), fill="black")
+        draw.text((width // 4, 140), header, fill="black")
+    else:
+        # Text-only header like most receipts, placed with a little jitter
+        y = 20 + rng.randint(-6, 6)
+        for text, size in ((header, 48), (address, 24), (f"STORE {rng.randint(1000, 9999)}", 24)):
+            font = ImageFont.load_default(size)
+            x = (width - draw.textlength(text, font=font)) / 2 + rng.randint(-8, 8)
+            draw.text((x, y), text, fill="black", font=font)
+            y += size + 12
+    for line in range(n_lines):
+        y = 260 + line * 40
+        draw.text((40, y), f"ITEM {rng.randint(100, 999)} {rng.randint(10, 999)}G", fill="black")
+        draw.text((width - 160, y), f"${rng.uniform(0.5, 20):.2f}", fill="black")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def bench_store_templates(n: int = 200):
+    """Cost of the header-band store lookup, prompt size saved, and cross-store false positives"""
+    import parser
+    from store_templates import FINGERPRINT_THRESHOLD, KNOWN_STORES, StoreTemplateCache
+
+    cache = StoreTemplateCache()
+    images = [make_receipt_image(i, "TARGET", width=3000, n_lines=100) for i in range(n)]
+    start = time.perf_counter()
+    for image in images:
+        cache.identify(image)
+    elapsed = time.perf_counter() - start
+
+    # Distinct receipts of one store (text-only header): learn from the first, look up the rest
+    same_store = [make_receipt_image(i, "TARGET", logo=False, address="100 MAIN ST") for i in range(n + 1)]
+    cache.learn_fingerprint("TARGET", cache.identify(same_store[0])[0])
+    hits = sum(cache.identify(image)[1] == "TARGET" for image in same_store[1:])
+
+    generic, short = len(parser.RECEIPT_PROMPT), len(cache.build_prompt("TARGET"))
+    print(f"store templates on {n} images ({len(images[0]) / 1024:.0f} KB each):")
+    print(f"   identify():      {elapsed / n * 1000:8.2f} ms/image")
+    print(f"   same store, {n} distinct receipts: hit rate {hits / n:.1%}")
+    print(f"   generic prompt:  {generic:8d} chars (~{generic // 4} tokens)")
+    print(f"   store prompt:    {short:8d} chars (~{short // 4} tokens)")
+
+    # Text-only headers of different stores: one learned receipt per store, then fresh receipts
+    stores = list(KNOWN_STORES)
+    per_store = max(1, n // len(stores))
+    cache = StoreTemplateCache()
+    for k, store in enumerate(stores):
+        image = make_receipt_image(k, store, logo=False, address=f"{100 + k} MAIN ST")
+        cache.learn_fingerprint(store, cache.identify(image)[0])
+    def run(offset: int, feedback: bool) -> Dict[str, int]:
+        counts = {"right": 0, "wrong": 0, "none": 0, "wrong_nearest_only": 0}
+        for k, store in enumerate(stores):
+            for i in range(per_store):
+                image = make_receipt_image(offset + i * 7 + k, store, logo=False, address=f"{100 + k} MAIN ST")
+                fp, found = cache.identify(image)
+                counts["right" if found == store else "none" if found is None else "wrong"] += 1
+                # What a nearest-within-threshold match (no uniqueness margin) would have picked
+                nearest = min(cache._nearest(fp).items(), key=lambda entry: entry[1])
+                counts["wrong_nearest_only"] += nearest[1] <= FINGERPRINT_THRESHOLD and nearest[0] != store
+                if feedback and found not in (None, store):
+                    # The returned store name did not confirm the candidate (see observe())
+                    cache.reject_fingerprint(found, fp)
+        return counts
+
+    total = per_store * len(stores)
+    print(f"   text-only headers of {len(stores)} stores ({len(cache.profiles)} learned), {total} fresh receipts:")
+    for label, counts in (("first pass", run(1000, feedback=True)), ("after feedback", run(5000, feedback=False))):
+        print(f"      {label:15} right {counts['right'] / total:6.1%}   wrong {counts['wrong'] / total:6.1%}"
+              f"   none {counts['none'] / total:6.1%}"
+              f"   (nearest match without margin: wrong {counts['wrong_nearest_only'] / total:.1%})")
+    print("      a wrong candidate costs one extra generic call; it is never used unconfirmed")
+
+
+def make_item_names(n: int, seed: int = 0) -> List[str]:
+    """Abbreviated receipt-style names drawn from a few thousand products"""
+    rng = random.Random(seed)
+    brands = ["FS", "HR", "ORG", "365WFM", "GV", "TJ", "KIRKLAND", "DEEP", "SWAD", "LAYS"]
+    words = ["GOBI", "PARATHA", "CHIPS", "PLN", "YGRT", "CHKN", "BRST", "BNNA", "MILK", "BRD",
+             "WHT", "RICE", "DAL", "SOAP", "DISH", "CHOC", "BAR", "TEA", "COFFEE", "LADOO"]
+    sizes = ["400G", "52G", "16OZ", "3L", "24PK", "2CT", "1.5LB", "500ML", ""]
+    products = [
+        f"{rng.choice(brands)} {' '.join(rng.sample(words, 3))}" for _ in range(max(1, n // 10))
+    ]
+    return [f"{rng.choice(products)} {rng.choice(sizes)}".strip() for _ in range(n)]
+
+
+def bench_item_index(n: int = 20_000):
+    """Inline lookup cost: first sight of a raw name vs cached repeats"""
+    from item_index import ItemIndex
+
+    names = make_item_names(n)
+    index = ItemIndex()
+    start = time.perf_counter()
+    for name in names:
+        index.lookup(name)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name in names:
+        index.lookup(name)
+    warm = time.perf_counter() - start
+
+    print(f"item index on {n} names ({len(set(names))} distinct, {len(index)} products):")
+    print(f"   first pass:   {cold / n * 1e6:8.1f} µs/lookup")
+    print(f"   cached:       {warm / n * 1e6:8.1f} µs/lookup")
+    print(f"   50-item receipt: {cold / n * 50 * 1000:.2f} ms worst case")
+
+    # Variants that differ only by a number, percentage or one word stay separate products
+    index = ItemIndex()
+    pairs = [("ORG WHL MILK GAL", "ORG 2% MILK GAL"), ("GRAPES", "GRAPES RED"), ("HR GOBI PARATHA", "HR ALOO PARATHA"),
+             ("BNNA ORG", "BANANAS ORGANIC"), ("GV WHT BRD", "GV WHITE BREAD 20OZ")]
+    for first, second in pairs:
+        a, b = index.lookup(first)["canonical_name"], index.lookup(second)["canonical_name"]
+        print(f"   {first!r:22} {second!r:24} -> {'same product' if a == b else 'separate'}")
+
+    # The index is saved by a background loop (ITEM_INDEX_SAVE_INTERVAL_S), not per receipt
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        index = ItemIndex(path=f"{tmp}/item_index.json")
+        for name in names:
+            index.lookup(name)
+        start = time.perf_counter()
+        index.save()
+        print(f"   background save of {len(index.raw_to_product)} names: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def bench_receipt_store(n: int = 20_000):
+    """GET /spend latency: precomputed daily aggregates vs scanning every receipt"""
+    import tempfile
+
+    from receipt_store import ReceiptStore
+
+    receipts = [Receipt.from_dict(r) for r in make_receipts(n)]
+    rng = random.Random(1)
+    for receipt in receipts:
+        receipt.date = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ReceiptStore(f"{tmp}/receipts.db")
+        start = time.perf_counter()
+        for receipt in receipts:
+            store.record(receipt)
+        write = time.perf_counter() - start
+
+        def scan(_):
+            with store._lock:
+                store._conn.execute(
+                    "SELECT store_key, date, SUM(total_cents) FROM receipts"
+                    " WHERE date >= '2025-03-01' AND date <= '2025-09-30' GROUP BY store_key, date"
+                ).fetchall()
+
+        def aggregate(_):
+            store.spend(date_from="2025-03-01", date_to="2025-09-30")
+
+        scanned = timed(scan, lambda: None, repeat=20)
+        aggregated = timed(aggregate, lambda: None, repeat=20)
+        store._conn.close()
+
+    print(f"receipt store with {n} receipts:")
+    print(f"   record():           {write / n * 1e6:8.1f} µs/receipt")
+    print(f"   spend, table scan:  {scanned * 1000:8.2f} ms")
+    print(f"   spend, aggregates:  {aggregated * 1000:8.2f} ms ({scanned / aggregated:.1f}x)")
+
+
+def serve_fake_sheet(rows: List[list]):
+    """Local HTTP server answering Sheets values:batchGet from an in-memory tab"""
+    import json
+    import re
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            value_ranges = []
+            for range_ in parse_qs(url.query).get("ranges", []):
+                first, last = map(int, re.findall(r"[A-Z]+(\d+)", range_.split("!", 1)[1]))
+                value_ranges.append({"range": range_, "values": rows[first - 1:last]})
+            body = json.dumps({"spreadsheetId": "fake", "valueRanges": value_ranges}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_sheet_import(n: int = 5_000):
+    """Backfill throughput (rows/s) against a local fake Sheets server, then a delta run"""
+    import os
+    import tempfile
+
+    import httplib2
+    from googleapiclient.discovery import build
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["RECEIPT_DB_PATH"] = f"{tmp}/receipts.db"
+        os.environ["ITEM_INDEX_PATH"] = f"{tmp}/item_index.json"
+        with contextlib.redirect_stderr(io.StringIO()):
+            import gsheet
+        gsheet.SPREADSHEET_ID = "fake"
+
+        receipts = [Receipt.from_dict(r) for r in make_receipts(n + 100)]
+        rows = [gsheet.HEADER_ROW]
+        for idx, receipt in enumerate(receipts[:n]):
+            rows.extend(gsheet.build_sheet_rows(receipt, f"2025-12-15 10:{idx // 60 % 60:02d}:{idx % 60:02d}"))
+
+        server = serve_fake_sheet(rows)
+        service = build(
+            "sheets", "v4", http=httplib2.Http(), static_discovery=True,
+            client_options={"api_endpoint": f"http://127.0.0.1:{server.server_port}"},
+        )
+        try:
+            full = gsheet.import_sheet(service=service)
+            for idx, receipt in enumerate(receipts[n:]):
+                rows.extend(gsheet.build_sheet_rows(receipt, f"2025-12-16 10:00:{idx % 60:02d}"))
+            delta = gsheet.import_sheet(service=service)
+        finally:
+            server.shutdown()
+            gsheet.receipt_store._conn.close()
+
+    print(f"sheet import of {len(rows) - 1} rows ({n} receipts):")
+    for label, stats in (("full", full), ("delta", delta)):
+        print(
+            f"   {label:6} {stats['rows']:8d} rows  {stats['receipts']:6d} receipts  "
+            f"{stats['requests']:3d} request(s)  {stats['seconds']:7.2f} s  {stats['rows_per_second']:10.0f} rows/s"
+        )
+
+
+class FakeSheetValues:
+    """In-process stand-in for spreadsheets().values().batchGet over a list of sheet rows"""
+
+    def __init__(self, rows: List[list]):
+        self.rows = rows
+        self.calls = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def batchGet(self, spreadsheetId: str, ranges: List[str], valueRenderOption: str):
+        self.calls += 1
+        value_ranges = []
+        for cells in ranges:
+            first, last = (int(ref.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")) for ref in cells.split("!")[1].split(":"))
+            page = self.rows[first - 1:last]
+            while page and not page[-1]:
+                page = page[:-1]  # like the API, trailing empty rows are not returned
+            value_ranges.append({"range": cells, **({"values": page} if page else {})})
+        self.result = {"valueRanges": value_ranges}
+        return self
+
+    def execute(self):
+        return self.result
+
+
+def check_sheet_import():
+    """Correctness of import_sheet paging: page-boundary splits, missing Total rows, end of data"""
+    import tempfile
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        import gsheet
+    from item_index import ItemIndex
+    from models import LineItem
+    from receipt_store import ReceiptStore
+
+    def receipt(receipt_id: str, n_items: int, total: float) -> Receipt:
+        items = [LineItem(name=f"ITEM {i}", line_total=1.0) for i in range(n_items)]
+        return Receipt(receipt_id=receipt_id, store_name="TARGET", date="2025-12-15", total=total, items=items)
+
+    def rows_of(r: Receipt, written_at: str, with_total: bool = True) -> List[list]:
+        rows = gsheet.build_sheet_rows(r, written_at)
+        return rows if with_total else rows[:-1]
+
+    page_rows, ranges_per_call = gsheet.IMPORT_PAGE_ROWS, gsheet.IMPORT_RANGES_PER_CALL
+    gsheet.IMPORT_PAGE_ROWS, gsheet.IMPORT_RANGES_PER_CALL = 4, 2
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            store, index = ReceiptStore(f"{tmp}/receipts.db"), ItemIndex()
+            sheet = [gsheet.HEADER_ROW]
+            sheet += rows_of(receipt("A", 2, 2.0), "2025-12-15 10:00:00")   # rows 2-4
+            sheet += rows_of(receipt("B", 9, 9.0), "2025-12-15 10:00:01")   # rows 5-14: spans pages and calls
+            sheet += rows_of(receipt("C", 3, 3.0), "2025-12-15 10:00:02", with_total=False)  # rows 15-17
+            # Same id and second as each other: only the Total row separates them
+            sheet += rows_of(receipt("D", 1, 1.0), "2025-12-15 10:00:03")   # rows 18-19
+            sheet += rows_of(receipt("D", 2, 2.0), "2025-12-15 10:00:03")   # rows 20-22
+            service = FakeSheetValues(sheet)
+
+            stats = gsheet.import_sheet(service=service, store=store, index=index)
+            found = {(r["receipt_id"], r["item_count"], r["total"]) for r in store.list_receipts(limit=100)}
+            expected = {("A", 2, 2.0), ("B", 9, 9.0), ("C", 3, 0.0), ("D", 1, 1.0), ("D", 2, 2.0)}
+            assert found == expected, f"imported {sorted(found)}, expected {sorted(expected)}"
+            assert stats["last_row"] == len(sheet) and stats["incomplete_rows"] == 0, stats
+            print("   ok  receipt split across pages and calls, receipt without Total row, same id and second")
+
+            # New rows exactly filling one call (2 pages x 4 rows): one more, empty call detects the end
+            sheet += rows_of(receipt("E", 7, 7.0), "2025-12-15 10:00:04")   # rows 23-30
+            service.calls = 0
+            stats = gsheet.import_sheet(service=service, store=store, index=index)
+            assert stats["inserted"] == 1 and stats["start_row"] == 23 and stats["last_row"] == len(sheet), stats
+            assert service.calls == 2, f"{service.calls} calls for data ending on a call boundary"
+            print("   ok  delta run reads only new rows and stops on an exhausted (empty) last page")
+
+            # A receipt still being written at the end (no Total yet) is left for the next run
+            sheet += rows_of(receipt("F", 2, 2.0), "2025-12-15 10:00:05", with_total=False)
+            stats = gsheet.import_sheet(service=service, store=store, index=index)
+            assert stats["inserted"] == 0 and stats["incomplete_rows"] == 2 and stats["last_row"] == len(sheet) - 2, stats
+            sheet += [rows_of(receipt("F", 2, 2.0), "2025-12-15 10:00:05")[-1]]
+            stats = gsheet.import_sheet(service=service, store=store, index=index)
+            assert stats["inserted"] == 1 and stats["last_row"] == len(sheet), stats
+            print("   ok  trailing receipt without Total waits for its Total row, then imports once")
+
+            stats = gsheet.import_sheet(service=service, store=store, index=index, full=True)
+            assert stats["inserted"] == 0 and stats["receipts"] == 7, stats
+            print("   ok  full re-import inserts nothing twice")
+            store._conn.close()
+    finally:
+        gsheet.IMPORT_PAGE_ROWS, gsheet.IMPORT_RANGES_PER_CALL = page_rows, ranges_per_call
+    print("sheet import checks passed")
+
+
+def make_photo(megapixels: int, seed: int = 0) -> bytes:
+    """Large noisy JPEG, like a phone photo of a receipt (well over 4 MB at 12 MP)"""
+    import numpy as np
+    from PIL import Image
+
+    width = int((megapixels * 1_000_000 * 3 / 4) ** 0.5)
+    height = megapixels * 1_000_000 // width
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(150, 256, size=(height, width, 3), dtype=np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+def legacy_prepare(image_bytes: bytes, max_edge: int = None) -> str:
+    """Pre-rework path: full-resolution compress pass, a second downscale pass, utf-8 decode"""
+    from PIL import Image
+
+    def reencode(image, quality):
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+    target_size = 4 * 1024 * 1024
+    if len(image_bytes) > target_size:
+        image = Image.open(io.BytesIO(image_bytes))
+        ratio = (target_size / len(image_bytes)) ** 0.5
+        image = image.resize(
+            (int(image.width * ratio * 0.95), int(image.height * ratio * 0.95)), Image.Resampling.LANCZOS
+        )
+        image_bytes = reencode(image, 92)
+    if max_edge:
+        image = Image.open(io.BytesIO(image_bytes))
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            image_bytes = reencode(image, 85)
+    return base64.b64encode(image_bytes).decode("utf-8")
+
+
+def decoded_megabytes(image_bytes: bytes, max_edge: int = None, draft: bool = True) -> float:
+    """Size of the largest pixel buffer a pipeline decodes (Pillow allocates it outside tracemalloc)"""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_bytes))
+    scale = 1.0
+    if len(image_bytes) > 4 * 1024 * 1024:
+        scale = (4 * 1024 * 1024 / len(image_bytes)) ** 0.5 * 0.95
+    if max_edge:
+        scale = min(scale, max_edge / max(image.size))
+    if draft and scale < 1.0:
+        image.draft("RGB", (int(image.width * scale), int(image.height * scale)))
+    return image.width * image.height * 3 / 1e6
+
+
+def bench_image_pipeline(megapixels: int = 12):
+    """Per-request peak allocation and time from upload bytes to the serialized API body"""
+    import json
+
+    import parser
+
+    photo = make_photo(megapixels)
+
+    def run(prepare, max_edge):
+        def request(_):
+            image_base64 = prepare(photo, max_edge)
+            body = json.dumps({"source": {"type": "base64", "media_type": "image/jpeg", "data": image_base64}})
+            return len(body)
+        return request
+
+    pipelines = (
+        ("legacy", legacy_prepare, False),
+        ("prepare_image", lambda data, edge: parser.encode_base64(parser.prepare_image(data, edge)[0]), True),
+    )
+    print(f"image pipeline on a {megapixels} MP photo ({len(photo) / 1e6:.1f} MB upload):")
+    for max_edge in (None, 1024, 768):
+        print(f"  max_edge={max_edge}")
+        for label, prepare, draft in pipelines:
+            elapsed = timed(run(prepare, max_edge), lambda: None, repeat=3)
+            gc.collect()
+            tracemalloc.start()
+            run(prepare, max_edge)(None)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            pixels = decoded_megabytes(photo, max_edge, draft)
+            print(f"   {label:14} {elapsed * 1000:8.0f} ms   Python buffers {peak / 1e6:6.1f} MB"
+                  f"   decoded pixels {pixels:6.1f} MB")
+
+
+def make_format_corpus(n: int) -> List[tuple]:
+    """(label, bytes) samples: receipt scans in each upload format plus large phone photos"""
+    from PIL import Image
+
+    from image_format import HEIF_SUPPORTED
+
+    formats = ["JPEG", "PNG", "WEBP", "BMP"] + (["HEIF"] if HEIF_SUPPORTED else [])
+    corpus = []
+    for seed in range(n):
+        scan = Image.open(io.BytesIO(make_receipt_image(seed, "TRADER JOE'S", n_lines=60, width=1500)))
+        for fmt in formats:
+            output = io.BytesIO()
+            scan.save(output, format=fmt)
+            corpus.append((fmt.lower(), output.getvalue()))
+    photo = make_photo(12)
+    corpus.append(("photo jpeg", photo))
+    output = io.BytesIO()
+    Image.open(io.BytesIO(photo)).save(output, format="PNG")
+    corpus.append(("photo png", output.getvalue()))
+    return corpus
+
+
+def bench_formats(n: int = 5):
+    """Wire bytes, media type and prepare latency per upload format, and WebP vs JPEG on conversions"""
+    from collections import defaultdict
+
+    import image_format
+
+    corpus = make_format_corpus(n)
+    rows = defaultdict(lambda: {"n": 0, "in": 0, "out": 0, "legacy": 0, "seconds": 0.0, "types": set()})
+    for label, data in corpus:
+        start = time.perf_counter()
+        wire, media_type = image_format.prepare_image(data)
+        elapsed = time.perf_counter() - start
+        row = rows[label]
+        row["n"] += 1
+        row["in"] += len(data)
+        row["out"] += len(wire)
+        row["legacy"] += len(base64.b64decode(legacy_prepare(data))) if len(data) > 4 * 1024 * 1024 else len(data)
+        row["seconds"] += elapsed
+        row["types"].add(media_type)
+
+    print(f"prepare_image on {len(corpus)} images (legacy = always sent as image/jpeg):")
+    print(f"   {'upload':12} {'n':>3} {'in KB':>9} {'legacy KB':>10} {'wire KB':>9} {'ms':>7}  media type")
+    for label, row in rows.items():
+        print(
+            f"   {label:12} {row['n']:3d} {row['in'] / row['n'] / 1024:9.0f} {row['legacy'] / row['n'] / 1024:10.0f}"
+            f" {row['out'] / row['n'] / 1024:9.0f} {row['seconds'] / row['n'] * 1000:7.1f}  {', '.join(sorted(row['types']))}"
+        )
+
+    from PIL import Image
+
+    print("wire format candidates at max quality:")
+    first = {label: data for label, data in reversed(corpus)}
+    for label in ("bmp", "photo jpeg"):
+        image = Image.open(io.BytesIO(first[label])).convert("RGB")
+        for name, (pil_format, quality) in image_format.WIRE_FORMATS.items():
+            start = time.perf_counter()
+            wire = image_format.encode(image, pil_format, quality)
+            print(f"   {label:12} {name:5} q{quality}  {len(wire) / 1024:9.0f} KB  {(time.perf_counter() - start) * 1000:7.1f} ms")
+
+
+def check_limiter(n: int = 2_000):
+    """AIMD slow-call signal on simulated receipts of mixed length: fixed 30 s cutoff vs per-token baseline"""
+    from resilience import AdaptiveLimiter
+
+    def simulate(limiter: AdaptiveLimiter, tokens_per_call: bool) -> Dict[str, float]:
+        rng = random.Random(0)
+        result = {}
+        for phase, slowdown, calls in (("normal", 1.0, n), ("congested", 3.0, 100)):
+            halvings = 0
+            for _ in range(calls):
+                tokens = rng.randint(300, 3000)   # short receipt .. long itemised receipt
+                latency = (1.5 + tokens * 0.012) * slowdown * rng.uniform(0.9, 1.1)
+                before = limiter.limit
+                limiter.in_flight += 1
+                limiter.release(latency, overloaded=False, output_tokens=tokens if tokens_per_call else 0)
+                halvings += limiter.limit < before
+            result[phase] = halvings / calls
+            result[f"{phase}_limit"] = limiter.limit
+        return result
+
+    legacy = simulate(AdaptiveLimiter(latency_target=30.0, latency_tolerance=float("inf")), tokens_per_call=False)
+    current = simulate(AdaptiveLimiter(), tokens_per_call=True)
+    assert current["normal"] == 0.0, "uncongested calls must not shrink the window"
+    assert current["congested"] > 0.0 and current["congested_limit"] < 2, "a 3x slowdown must shrink the window"
+    print(f"AIMD limiter on {n} normal then 100 congested calls (300-3000 output tokens, 3x slowdown):")
+    for label, r in (("fixed 30 s", legacy), ("per-token base", current)):
+        print(f"   {label:15} normal: {r['normal']:6.1%} of calls halve, limit {r['normal_limit']:5.1f}"
+              f"   congested: {r['congested']:6.1%} halve, limit {r['congested_limit']:5.1f}")
+
+
+BENCHMARKS = {
+    "validation": bench_validation,
+    "models": bench_models,
+    "logging": bench_logging,
+    "store_templates": bench_store_templates,
+    "item_index": bench_item_index,
+    "receipt_store": bench_receipt_store,
+    "sheet_import": bench_sheet_import,
+    "sheet_import_check": check_sheet_import,
+    "image_pipeline": bench_image_pipeline,
+    "formats": bench_formats,
+    "limiter_check": check_limiter,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]](*(int(a) for a in sys.argv[2:]))
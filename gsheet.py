@@ -1,13 +1,25 @@
 import os,json, tempfile
+import dataclasses
+import logging
+import threading
+import time
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from dotenv import load_dotenv
 from pathlib import Path
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from item_index import ItemIndex
+from models import LineItem, Receipt
+from receipt_store import ReceiptStore
+from shared_state import SheetWriteBuffer, get_shared_state
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 SPREADSHEET_ID = os.getenv("spreadsheet_id")
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -20,9 +32,9 @@ if google_cred:
         json.dump(cred_dict, temp_file)
         temp_file.close()
         CREDENTIALS_PATH = Path(temp_file.name)
-        print(f"☑️ Using GOOGLE_CREDS_JSON from environment")
+        logger.info("☑️ Using GOOGLE_CREDS_JSON from environment")
     except json.JSONDecodeError as e:
-        print(f"❌ Failed to parse GOOGLE_CREDS_JSON: {e}" )
+        logger.error("❌ Failed to parse GOOGLE_CREDS_JSON: %s", e)
         CREDENTIALS_PATH = None
 else:
     env_cred = os.getenv("GOOGLE_CREDS_PATH")
@@ -32,12 +44,26 @@ else:
             CREDENTIALS_PATH = BASE_DIR / CREDENTIALS_PATH
     else:
         CREDENTIALS_PATH = BASE_DIR / "secrets" / "receipt-credentials.json"
-    print(f"✅ Using credentials file: {CREDENTIALS_PATH}")
+    logger.info("✅ Using credentials file: %s", CREDENTIALS_PATH)
 
 
 
 SHEET_NAME = "Reciepts"
 
+# Raw item names -> canonical products, grown as receipts are written and
+# saved in the background every ITEM_INDEX_SAVE_INTERVAL_S, not per receipt
+item_index = ItemIndex(path=os.getenv("ITEM_INDEX_PATH", "item_index.json"))
+ITEM_INDEX_SAVE_INTERVAL_S = float(os.getenv("ITEM_INDEX_SAVE_INTERVAL_S", "30"))
+
+# Local mirror of everything written to the sheet, for the query API
+receipt_store = ReceiptStore(os.getenv("RECEIPT_DB_PATH", "receipts.db"))
+
+# Rows from every worker are queued here and written in coalesced appends
+# (SHEET_WRITE_BUFFER=1, requires SHARED_STATE=1)
+_shared = get_shared_state()
+write_buffer = SheetWriteBuffer(_shared) if _shared and os.getenv("SHEET_WRITE_BUFFER", "0") == "1" else None
+FLUSH_INTERVAL_S = float(os.getenv("SHEET_FLUSH_INTERVAL_S", "5"))
+
 
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
@@ -87,93 +113,73 @@ def ensure_header(service):
         values = result.get("values", [])
         
         if not values:
-            print("📝 No header found, creating header row...")
+            logger.info("📝 No header found, creating header row...")
             service.spreadsheets().values().update(
                 spreadsheetId=SPREADSHEET_ID,
                 range=f"{SHEET_NAME}!A1",
                 valueInputOption="RAW",
                 body={"values": [HEADER_ROW]},
             ).execute()
-            print("✅ Header created")
+            logger.info("✅ Header created")
         else:
-            print("✓ Header already present:", values[0])
+            logger.debug("✓ Header already present: %s", values[0])
 
     except Exception as e:
-        print(f"⚠️ Error checking/creating header: {e}")
+        logger.error("⚠️ Error checking/creating header: %s", e)
         raise
 
 
-def append_to_sheet(data: dict):
+def build_sheet_rows(receipt: Receipt, timestamp: str) -> list:
     """
-    Append parsed receipt data to Google Sheets.
-    Creates ONE ROW PER ITEM for detailed tracking.
-
-    Args: 
-        data: Dict containing receipt_id, store_name, date, total, items, 
-              payment_method, card_last_4, raw_text
-
-    Return:
-        API response from the append operation
+    Convert a receipt into sheet rows: ONE ROW PER ITEM plus a "Total" row,
+    or a single summary row when no items were detected.
     """
-    print(f"\n📊 Processing receipt: {data.get('receipt_id')}")
-    
-    service = get_service()
-    ensure_header(service)
-
-    # Generate timestamp
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
     # Extract common receipt info
-    receipt_id = data.get("receipt_id") or "UNKNOWN"
-    store_name = data.get("store_name") or "Unknown Store"
-    address = data.get("address") or ""
-    receipt_date = data.get("date") or ""
-    subtotal = data.get("subtotal") or ""
-    tax = data.get("tax") or ""
-    total = data.get("total") or ""
-    payment_method = data.get("payment_method") or ""
-    card_last_4 = data.get("card_last_4") or ""
-    raw_text = data.get("raw_text") or ""
-    items = data.get("items", [])
+    receipt_id = receipt.receipt_id or "UNKNOWN"
+    store_name = receipt.store_name or "Unknown Store"
+    address = receipt.address or ""
+    receipt_date = receipt.date or ""
+    tax = receipt.tax or ""
+    total = receipt.total or ""
+    payment_method = receipt.payment_method or ""
+    card_last_4 = receipt.card_last_4 or ""
+    raw_text = receipt.raw_text or ""
+    items = receipt.items
     
-    print(f"📝 Receipt Info:")
-    print(f"   Receipt ID: {receipt_id}")
-    print(f"   Store: {store_name}")
-    print(f"   Date: {receipt_date}")
-    print(f"   Total: ${total}")
-    print(f"   Payment: {payment_method} {card_last_4}")
-    print(f"   Items: {len(items)}")
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug(
+            "📝 Receipt Info: id=%s store=%s date=%s total=$%s payment=%s %s items=%d",
+            receipt_id, store_name, receipt_date, total, payment_method, card_last_4, len(items),
+        )
     
     # Create one row per item
     values = []
     
-    if items and len(items) > 0:
+    if items:
         # One row for each item
         for idx, item in enumerate(items, 1):
-            item_name = item.get("name", "").strip()
-            item_price = item.get("line_total")  # FIXED: Changed from "price" to "line_total"
-            item_unitprice = item.get("unit_price")  # FIXED: Changed from "unit price" to "unit_price"
-            item_tax = item.get("itemized_tax")  # This may not exist in parser output
-            item_quantiy = item.get("quantity")
+            item_name = item.name.strip()
+            item_price = item.line_total
             
             # Skip items without valid name or price
             if not item_name:
-                print(f"   ⚠️  Skipping item without name")
+                logger.debug("⚠️  Skipping item without name")
                 continue
             
             # Convert None to 0 or skip if price is invalid
             if item_price is None:
-                print(f"   ⚠️  Skipping item with no price: {item_name}")
+                logger.debug("⚠️  Skipping item with no price: %s", item_name)
                 continue
             
             # Ensure price is a number
             try:
                 item_price = float(item_price)
                 if item_price <= 0:
-                    print(f"   ⚠️  Skipping item with invalid price: {item_name} ${item_price}")
+                    logger.debug("⚠️  Skipping item with invalid price: %s $%s", item_name, item_price)
                     continue
             except (ValueError, TypeError):
-                print(f"   ⚠️  Skipping item with invalid price: {item_name}")
+                logger.debug("⚠️  Skipping item with invalid price: %s", item_name)
                 continue
             
             row = [
@@ -182,9 +188,9 @@ def append_to_sheet(data: dict):
                 store_name,
                 receipt_date,
                 item_name,
-                item_unitprice,
-                item_quantiy,
-                item_tax,
+                item.unit_price,
+                item.quantity,
+                None,  # per-item tax is not itemized by the parser
                 item_price,
                 payment_method,
                 card_last_4,
@@ -193,12 +199,13 @@ def append_to_sheet(data: dict):
                 raw_text if idx == 1 else "",  # Only include raw text on first item to save space
             ]
             values.append(row)
-            print(f"      {idx}. {item_name}: ${item_price}")
+            if debug:
+                logger.debug("%d. %s: $%s", idx, item_name, item_price)
         lst_row = [receipt_id, timestamp, store_name, receipt_date, "Total",None,None,tax, total, payment_method, card_last_4]
         values.append(lst_row)
     else:
         # No items found - create one summary row
-        print("   ⚠️  No items found, creating summary row")
+        logger.warning("⚠️  No items found, creating summary row", extra={"receipt_id": receipt_id})
         row = [
             receipt_id,
             timestamp,
@@ -214,28 +221,328 @@ def append_to_sheet(data: dict):
         ]
         values.append(row)
     
-    range_ = f"{SHEET_NAME}!A2"
+    return values
 
+
+def append_to_sheet(data):
+    """
+    Append parsed receipt data to Google Sheets.
+    Creates ONE ROW PER ITEM for detailed tracking.
+
+    Args: 
+        data: Receipt (or a dict in the parser's JSON shape with receipt_id,
+              store_name, date, total, items, payment_method, card_last_4, raw_text)
+
+    Return:
+        API response from the append operation (with the write buffer on, a
+        summary for this receipt: "buffered" stays true and updatedRows is 0
+        while its rows are still queued)
+    """
+    receipt = data if isinstance(data, Receipt) else Receipt.from_dict(data)
+    logger.info("📊 Processing receipt: %s", receipt.receipt_id)
+
+    # Canonical product names for analytics, computed inline per item
+    item_index.annotate(receipt)
+
+    # Generate timestamp
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    values = build_sheet_rows(receipt, timestamp)
+
+    if write_buffer is not None:
+        outbox_id = write_buffer.enqueue(dataclasses.asdict(receipt), timestamp, values)
+        try:
+            # Carries along whatever other workers queued in the meantime
+            flushed = _flush_write_buffer()
+        except Exception as e:
+            # The rows are safe in the buffer; the background flusher retries
+            logger.warning("⚠️ Sheet write deferred for %s: %s", receipt.receipt_id, e)
+            flushed = []
+        # Written by this flush or already by another worker's; else still queued
+        written = outbox_id in flushed or not write_buffer.is_pending(outbox_id)
+        return {
+            "buffered": not written,
+            "flushed": len(flushed),
+            "updates": {
+                "updatedRows": len(values) if written else 0,
+                "updatedCells": sum(len(row) for row in values) if written else 0,
+            },
+        }
+
+    service = get_service()
+    ensure_header(service)
+    result = _append_rows(service, values)
+    receipt_store.record(receipt, timestamp)
+
+    rows_added = len(values)
+    logger.info(
+        "✅ Added %d row(s) to sheet, updated %d cells", rows_added, result["updates"]["updatedCells"],
+        extra={"receipt_id": receipt.receipt_id, "rows_added": rows_added},
+    )
+    return result
+
+
+def _append_rows(service, values: list) -> dict:
     try:
-        result = service.spreadsheets().values().append(
+        return service.spreadsheets().values().append(
             spreadsheetId=SPREADSHEET_ID,
-            range=range_,
+            range=f"{SHEET_NAME}!A2",
             valueInputOption="RAW",
             insertDataOption="INSERT_ROWS",
             body={"values": values},
         ).execute()
-        
-        rows_added = len(values)
-        print(f"\n✅ Added {rows_added} row(s) to sheet")
-        print(f"   Updated {result['updates']['updatedCells']} cells\n")
-        return result
-        
     except Exception as e:
-        print(f"❌ Error appending to sheet: {e}")
+        logger.error("❌ Error appending to sheet: %s", e)
         raise
 
 
+def flush_write_buffer() -> int:
+    """
+    Write everything queued by any worker in one append; returns receipts written.
+    Failed writes are handed back to the buffer for the next flush.
+    """
+    return len(_flush_write_buffer())
+
+
+def _flush_write_buffer() -> List[int]:
+    """Outbox ids written by one coalesced append"""
+    if write_buffer is None:
+        return []
+    entries = write_buffer.claim()
+    if not entries:
+        return []
+
+    ids = [entry[0] for entry in entries]
+    values = [row for entry in entries for row in entry[3]]
+    try:
+        service = get_service()
+        ensure_header(service)
+        result = _append_rows(service, values)
+    except Exception:
+        write_buffer.release(ids)
+        raise
+    write_buffer.complete(ids)
+    receipt_store.record_many([(Receipt.from_dict(receipt), written_at) for _, receipt, written_at, _ in entries])
+
+    logger.info(
+        "✅ Flushed %d receipt(s) as %d row(s), updated %d cells",
+        len(entries), len(values), result["updates"]["updatedCells"],
+        extra={"receipts": len(entries), "rows_added": len(values)},
+    )
+    return ids
+
+
+def run_write_buffer_flusher(stop: threading.Event):
+    """Background loop that drains rows whose inline flush failed"""
+    while not stop.wait(FLUSH_INTERVAL_S):
+        try:
+            flush_write_buffer()
+        except Exception as e:
+            logger.warning("⚠️ Sheet write buffer flush failed, will retry: %s", e)
+
+
+def run_item_index_saver(stop: threading.Event):
+    """Background loop that saves new item names, keeping the JSON rewrite off the request path"""
+    while not stop.wait(ITEM_INDEX_SAVE_INTERVAL_S):
+        item_index.save_if_changed()
+
+
+# ----------------------------------------------------------------------
+# Backfill: rebuild receipts from rows already in the sheet
+# ----------------------------------------------------------------------
+
+# Rows per range and ranges per batchGet call (~20k rows per request by default)
+IMPORT_PAGE_ROWS = int(os.getenv("SHEET_IMPORT_PAGE_ROWS", "5000"))
+IMPORT_RANGES_PER_CALL = int(os.getenv("SHEET_IMPORT_RANGES_PER_CALL", "4"))
+
+# Last sheet row already imported, kept in the receipt store's meta table
+IMPORT_CHECKPOINT_KEY = "sheet_import_last_row"
+
+SUMMARY_ROW_NAME = "No items detected"
+
+
+def _cell(row: list, idx: int):
+    value = row[idx] if idx < len(row) else None
+    return None if value == "" else value
+
+
+def _number(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _item_category(name: str) -> str:
+    upper = name.upper()
+    if "TAX" in upper.split():
+        return "tax"
+    if "DEPOSIT" in upper:
+        return "deposit"
+    if "FEE" in upper:
+        return "fee"
+    return "product"
+
+
+def receipt_from_rows(rows: list) -> Receipt:
+    """Inverse of build_sheet_rows for one receipt's rows"""
+    first = rows[0]
+    store_name = _cell(first, 2)
+    receipt = Receipt(
+        receipt_id=_text(_cell(first, 0)) or "UNKNOWN",
+        store_name=None if store_name == "Unknown Store" else _text(store_name),
+        date=_text(_cell(first, 3)),
+    )
+
+    if _cell(first, 4) == SUMMARY_ROW_NAME:
+        receipt.payment_method = _text(_cell(first, 6))
+        receipt.card_last_4 = _text(_cell(first, 7))
+        receipt.total = _number(_cell(first, 8))
+        receipt.address = _text(_cell(first, 9))
+        receipt.raw_text = _text(_cell(first, 10))
+        return receipt
+
+    for row in rows:
+        name = _text(_cell(row, 4)) or ""
+        if name == "Total":
+            receipt.tax = _number(_cell(row, 7), None)
+            receipt.total = _number(_cell(row, 8))
+            receipt.payment_method = _text(_cell(row, 9))
+            receipt.card_last_4 = _text(_cell(row, 10))
+            continue
+        receipt.items.append(LineItem(
+            name=name,
+            quantity=int(_number(_cell(row, 6), 1)),
+            unit_price=_number(_cell(row, 5)),
+            line_total=_number(_cell(row, 8)),
+            category=_item_category(name),
+        ))
+        if receipt.address is None:
+            receipt.address = _text(_cell(row, 11))
+            receipt.raw_text = _text(_cell(row, 12))
+    return receipt
+
+
+def group_sheet_rows(rows: list, first_row: int) -> Tuple[List[Tuple[Receipt, str]], int]:
+    """
+    Split consecutive sheet rows into receipts.
+
+    Returns (receipt, timestamp) pairs and the number of rows consumed; rows of a
+    receipt whose "Total" row has not been read yet are left for the next page.
+    """
+    receipts = []
+    pending: list = []
+    consumed = 0
+    for offset, row in enumerate(rows):
+        if not row or not _cell(row, 0):
+            if not pending:
+                consumed = offset + 1
+            continue
+        key = (row[0], _cell(row, 1))
+        if pending and (pending[0][0], _cell(pending[0], 1)) != key:
+            # Previous receipt never got a Total row - keep what was written
+            logger.debug("⚠️  Receipt %s at row %d has no Total row", pending[0][0], first_row + consumed)
+            receipts.append((receipt_from_rows(pending), _text(_cell(pending[0], 1))))
+            pending = []
+            consumed = offset
+        pending.append(row)
+        if _cell(row, 4) in ("Total", SUMMARY_ROW_NAME):
+            receipts.append((receipt_from_rows(pending), _text(key[1])))
+            pending = []
+            consumed = offset + 1
+    return receipts, consumed
+
+
+def import_sheet(service=None, store: Optional[ReceiptStore] = None, index: Optional[ItemIndex] = None,
+                 full: bool = False) -> Dict:
+    """
+    Backfill the local receipt store and item index from the sheet.
+
+    Pages through the tab with large-range batchGet calls starting after the
+    last checkpointed row, so repeat runs only fetch rows appended since.
+    """
+    service = service or get_service()
+    store = store or receipt_store
+    index = index or item_index
+
+    checkpoint = 1 if full else int(store.get_meta(IMPORT_CHECKPOINT_KEY) or 1)  # row 1 is the header
+    stats = {"start_row": checkpoint + 1, "rows": 0, "receipts": 0, "inserted": 0, "requests": 0}
+    start = time.perf_counter()
+    buffered: list = []   # rows of a receipt split across two requests
+    next_row = checkpoint + 1
+
+    while True:
+        ranges = [
+            f"{SHEET_NAME}!A{next_row + i * IMPORT_PAGE_ROWS}:M{next_row + (i + 1) * IMPORT_PAGE_ROWS - 1}"
+            for i in range(IMPORT_RANGES_PER_CALL)
+        ]
+        result = service.spreadsheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=ranges,
+            valueRenderOption="UNFORMATTED_VALUE",
+        ).execute()
+        stats["requests"] += 1
+
+        # Pad short pages so row positions stay aligned with sheet row numbers;
+        # a short final page means the end of the data was reached
+        rows: list = []
+        pages = [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
+        for page in pages:
+            rows.extend(page + [[]] * (IMPORT_PAGE_ROWS - len(page)))
+        exhausted = not pages or len(pages[-1]) < IMPORT_PAGE_ROWS
+        while exhausted and rows and not rows[-1]:
+            rows.pop()
+        stats["rows"] += len(rows)
+        next_row += IMPORT_PAGE_ROWS * IMPORT_RANGES_PER_CALL
+
+        first_row = checkpoint + 1
+        receipts, consumed = group_sheet_rows(buffered + rows, first_row)
+        buffered = (buffered + rows)[consumed:]
+
+        new_names = 0
+        for receipt, _ in receipts:
+            new_names += index.annotate(receipt)
+        stats["receipts"] += len(receipts)
+        stats["inserted"] += store.record_many(receipts)
+        checkpoint += consumed
+        store.set_meta(IMPORT_CHECKPOINT_KEY, str(checkpoint))
+        if new_names:
+            index.save()
+
+        logger.info(
+            "📥 Imported through row %d: %d receipt(s) so far", checkpoint, stats["receipts"],
+            extra={"rows": stats["rows"], "requests": stats["requests"]},
+        )
+        if exhausted:
+            break
+
+    elapsed = time.perf_counter() - start
+    stats.update(
+        last_row=checkpoint,
+        incomplete_rows=len(buffered),
+        seconds=round(elapsed, 3),
+        rows_per_second=round(stats["rows"] / elapsed, 1) if elapsed else None,
+    )
+    logger.info(
+        "✅ Sheet import done: %d row(s), %d receipt(s), %d new", stats["rows"], stats["receipts"], stats["inserted"],
+        extra=stats,
+    )
+    return stats
+
+
 if __name__ == "__main__":
+    import sys
+    from logging_setup import configure_logging
+    configure_logging()
+
+    if sys.argv[1:2] == ["import"]:
+        # python gsheet.py import [--full]
+        print(json.dumps(import_sheet(full="--full" in sys.argv), indent=2))
+        sys.exit(0)
+
     test_data = {
         "receipt_id": "TEST123",
         "store_name": "Test Store",
@@ -255,4 +562,5 @@ if __name__ == "__main__":
 
     print("\n🧪 Testing Google Sheets integration with itemized rows...\n")
     append_to_sheet(test_data)
+    item_index.save_if_changed()
     print("✅ Test complete. Check your Google Sheet!")
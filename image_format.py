@@ -0,0 +1,166 @@
+"""
+Image format detection and wire encoding for the vision API - sniffs the
+real format from magic bytes, passes supported images through untouched
+with the right media type, and otherwise converts (HEIC included, via
+pillow-heif) to JPEG, falling back to WebP only when JPEG does not fit
+"""
+import io
+import logging
+import os
+from typing import Optional, Tuple
+
+from PIL import Image
+
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_SUPPORTED = True
+except ImportError:
+    HEIF_SUPPORTED = False
+
+logger = logging.getLogger(__name__)
+
+# Largest image sent as-is, and the cap on decoded size (decompression bombs).
+# PIL only warns between 1x and 2x its own limit, so open_image() checks explicitly
+MAX_IMAGE_BYTES = 4 * 1024 * 1024
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "60000000"))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Formats the vision API accepts, by sniffed format
+MEDIA_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",
+}
+
+# Wire formats for conversions: (PIL format, max quality). The first enabled one is
+# used; later ones are tried only when it does not fit at its max quality
+WIRE_FORMATS = {
+    "webp": ("WEBP", 90),
+    "jpeg": ("JPEG", 92),
+}
+ENABLED_WIRE_FORMATS = [f.strip() for f in os.getenv("VISION_WIRE_FORMATS", "jpeg,webp").split(",") if f.strip()]
+
+# Below this quality small receipt text starts to smear
+MIN_QUALITY = 60
+
+# WebP encodes ~10x slower than JPEG; above this size it costs more time than it saves
+WEBP_MAX_PIXELS = int(os.getenv("WEBP_MAX_PIXELS", "3000000"))
+
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"hevm", b"hevs", b"mif1", b"msf1"}
+
+
+class ImageTooLargeError(ValueError):
+    """Decoded image would exceed MAX_IMAGE_PIXELS"""
+
+
+def open_image(image_bytes: bytes) -> Image.Image:
+    """Open from the header only and reject images over MAX_IMAGE_PIXELS before any decode"""
+    image = Image.open(io.BytesIO(image_bytes))  # BytesIO shares the bytes
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(
+            f"Image is {image.width}x{image.height} pixels; the limit is {MAX_IMAGE_PIXELS // 1_000_000} MP"
+        )
+    return image
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """Format from the leading magic bytes: jpeg, png, gif, webp, heic, tiff, bmp or None"""
+    head = bytes(data[:16])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        return "heic"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[:2] == b"BM":
+        return "bmp"
+    return None
+
+
+def encode(image: Image.Image, fmt: str, quality: int) -> bytes:
+    output = io.BytesIO()
+    if fmt == "WEBP":
+        image.save(output, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def quality_search(image: Image.Image, fmt: str, max_quality: int, target_bytes: int) -> Tuple[bytes, int]:
+    """Highest quality in [MIN_QUALITY, max_quality] that fits target_bytes (binary search)"""
+    data = encode(image, fmt, max_quality)
+    if len(data) <= target_bytes:
+        return data, max_quality
+
+    best, best_quality = None, None
+    low, high = MIN_QUALITY, max_quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = encode(image, fmt, quality)
+        if len(candidate) <= target_bytes:
+            best, best_quality = candidate, quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        # Even MIN_QUALITY is too big; the caller's size check decides
+        return encode(image, fmt, MIN_QUALITY), MIN_QUALITY
+    return best, best_quality
+
+
+def prepare_image(image_bytes: bytes, max_edge: Optional[int] = None) -> Tuple[bytes, str]:
+    """
+    (wire bytes, media type) for one image. A supported format within
+    MAX_IMAGE_BYTES and max_edge is returned as the same object, uncopied;
+    anything else is decoded once (JPEG at reduced scale where possible),
+    resized once, and encoded as the first enabled wire format that fits
+    at full quality (else the one that fits at the highest quality).
+    """
+    fmt = sniff_format(image_bytes)
+    if fmt == "heic" and not HEIF_SUPPORTED:
+        raise ValueError("HEIC image received but pillow-heif is not installed")
+
+    image = open_image(image_bytes)
+    scale = 1.0
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        scale = (MAX_IMAGE_BYTES / len(image_bytes)) ** 0.5 * 0.95
+    if max_edge and max(image.size) > max_edge:
+        scale = min(scale, max_edge / max(image.size))
+    if scale >= 1.0 and fmt in MEDIA_TYPES:
+        logger.debug("✓ Image OK: %s %.2f MB", fmt, len(image_bytes) / 1024 / 1024)
+        return image_bytes, MEDIA_TYPES[fmt]
+
+    logger.info("📦 Converting %s: %.2f MB", fmt or image.format, len(image_bytes) / 1024 / 1024)
+    new_size = (max(1, int(image.width * min(scale, 1.0))), max(1, int(image.height * min(scale, 1.0))))
+    # JPEG: decode straight at 1/2, 1/4 or 1/8 scale instead of full resolution
+    image.draft("RGB", new_size)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if image.size != new_size:
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+    best, best_rank = None, None
+    for name in ENABLED_WIRE_FORMATS:
+        if name == "webp" and image.width * image.height > WEBP_MAX_PIXELS:
+            continue
+        pil_format, max_quality = WIRE_FORMATS[name]
+        data, quality = quality_search(image, pil_format, max_quality, MAX_IMAGE_BYTES)
+        logger.debug("   %s q%d: %.2f MB", name, quality, len(data) / 1024 / 1024)
+        rank = (len(data) <= MAX_IMAGE_BYTES, quality - max_quality, -len(data))
+        if best is None or rank > best_rank:
+            best, best_rank = (data, MEDIA_TYPES[name]), rank
+        if quality == max_quality:
+            break
+
+    if best is None:
+        best = (quality_search(image, "JPEG", WIRE_FORMATS["jpeg"][1], MAX_IMAGE_BYTES)[0], "image/jpeg")
+    logger.info("✓ Converted to %s: %.2f MB", best[1], len(best[0]) / 1024 / 1024)
+    return best
@@ -0,0 +1,235 @@
+"""
+Item-name normalization index - maps abbreviated names as printed
+("FS HR GOBI PARATHA 400G") to canonical products plus a parsed size/unit,
+using a character-trigram index and a cache of every raw name seen
+"""
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from shared_state import file_lock, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# Size/weight suffixes the parser prompt tells the model are NOT quantities:
+# 400G, 52G, 3L, 7OZ/7Z, 1.5LB, 0.5KG, 24P/24PK, 2CT, 16.9 FL OZ, 500ML
+SIZE_PATTERN = re.compile(
+    r"(?<![A-Z0-9.])(\d+(?:\.\d+)?)\s*(FL\s*OZ|OZ|Z|G|KG|LB|LBS|ML|L|CT|PK|P)(?![A-Z])"
+)
+UNITS = {
+    "FLOZ": "fl oz", "OZ": "oz", "Z": "oz", "G": "g", "KG": "kg", "LB": "lb", "LBS": "lb",
+    "ML": "ml", "L": "l", "CT": "ct", "PK": "pk", "P": "pk",
+}
+
+# Common receipt abbreviations, expanded before matching
+ABBREVIATIONS = {
+    "ORG": "ORGANIC", "CHKN": "CHICKEN", "BNLS": "BONELESS", "SKNLS": "SKINLESS",
+    "PLN": "PLAIN", "VEG": "VEGETABLE", "VEGS": "VEGETABLES", "WHL": "WHOLE", "GAL": "GALLON",
+    "BRST": "BREAST", "GRN": "GREEN", "RD": "RED", "YLW": "YELLOW", "CHOC": "CHOCOLATE",
+    "STRWBRY": "STRAWBERRY", "STRAWB": "STRAWBERRY", "BNNA": "BANANA", "BANANAS": "BANANA",
+    "TOM": "TOMATO", "TOMATOES": "TOMATO", "POT": "POTATO", "POTATOES": "POTATO",
+    "CRM": "CREAM", "CHS": "CHEESE", "BTR": "BUTTER", "YGRT": "YOGURT", "YOG": "YOGURT",
+    "BRD": "BREAD", "WHT": "WHITE", "WW": "WHOLE WHEAT", "FRZ": "FROZEN", "FZN": "FROZEN",
+    "PKG": "PACKAGE", "LG": "LARGE", "SM": "SMALL", "MED": "MEDIUM", "XL": "EXTRA LARGE",
+}
+
+# Codes printed around names: DPCI (Target), UPC (Walmart), PLU, trailing tax flags
+CODE_PATTERN = re.compile(r"\b\d{4,}\b|\b\d{3}-\d{2}-\d{4}\b")
+WEIGHTED_PATTERN = re.compile(r"\bWT\b|\d+(?:\.\d+)?\s*LB\s*@.*$|@.*$")
+
+# Minimum trigram Jaccard similarity to join an existing product
+MATCH_THRESHOLD = 0.6
+
+
+def parse_size(name: str) -> Tuple[Optional[float], Optional[str]]:
+    """Package size and unit from an item name, e.g. '... 400G' -> (400.0, 'g')"""
+    matches = SIZE_PATTERN.findall(name.upper())
+    if not matches:
+        return None, None
+    amount, unit = matches[-1]
+    return float(amount), UNITS[re.sub(r"\s+", "", unit)]
+
+
+def normalize_name(name: str) -> str:
+    """
+    Upper-cased product words: codes, sizes and weights removed, abbreviations
+    expanded. Short numbers and percentages ("2%", "7 GRAIN") are kept.
+    """
+    text = name.upper()
+    text = WEIGHTED_PATTERN.sub(" ", text)
+    text = SIZE_PATTERN.sub(" ", text)
+    text = CODE_PATTERN.sub(" ", text)
+    words = [word.rstrip(".") for word in re.findall(r"[A-Z0-9][A-Z0-9'.%]*", text)]
+    words = [ABBREVIATIONS.get(word, word) for word in words]
+    return " ".join(words)
+
+
+def compatible(a: str, b: str) -> bool:
+    """
+    Whether two normalized names may be the same product: the same number and
+    percentage tokens, and every word of each has a counterpart in the other
+    sharing its first three letters ("GRAPES RED" is not "GRAPES")
+    """
+    words_a, words_b = a.split(), b.split()
+    numbers_a = {word for word in words_a if any(c.isdigit() for c in word)}
+    numbers_b = {word for word in words_b if any(c.isdigit() for c in word)}
+    if numbers_a != numbers_b:
+        return False
+    prefixes_a = {word[:3] for word in words_a if word not in numbers_a}
+    prefixes_b = {word[:3] for word in words_b if word not in numbers_b}
+    return prefixes_a == prefixes_b
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ItemIndex:
+    """
+    Incremental raw-name -> canonical-product index, persisted as JSON.
+    Product ids are local to the process; the file is merged by canonical
+    name, so several workers can share it.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.products: List[str] = []          # canonical names, index = product id
+        self.raw_to_product: Dict[str, int] = {}
+        self.postings: Dict[str, List[int]] = {}
+        self._trigrams: List[set] = []
+        self._product_ids: Dict[str, int] = {}
+        self._dirty = False   # raw names added since the last save
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def lookup(self, raw_name: str) -> Dict:
+        """Canonical product, size and unit for a raw item name (adds it if new)"""
+        size, unit = parse_size(raw_name)
+        with self._lock:
+            product_id = self.raw_to_product.get(raw_name)
+            if product_id is None:
+                product_id = self._match_or_add(normalize_name(raw_name) or raw_name.upper().strip())
+                self.raw_to_product[raw_name] = product_id
+                self._dirty = True
+            canonical = self.products[product_id]
+        return {"canonical_name": canonical, "size": size, "unit": unit}
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[str, float]]:
+        """Canonical products most similar to a free-text query"""
+        grams = trigrams(normalize_name(query) or query.upper())
+        with self._lock:
+            scored = [
+                (self.products[pid], self._similarity(grams, pid))
+                for pid, _ in self._candidates(grams).most_common(limit * 5)
+            ]
+        scored.sort(key=lambda pair: pair[1], reverse=True)
+        return scored[:limit]
+
+    def annotate(self, receipt) -> int:
+        """Fill canonical_name/size/unit on every product line; returns new raw names"""
+        before = len(self.raw_to_product)
+        for item in receipt.items:
+            if item.category != "product" or not item.name:
+                continue
+            info = self.lookup(item.name)
+            item.canonical_name = info["canonical_name"]
+            item.size = info["size"]
+            item.unit = info["unit"]
+        return len(self.raw_to_product) - before
+
+    # ------------------------------------------------------------------
+
+    def _candidates(self, grams: set) -> Counter:
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.postings.get(gram, ()))
+        return counts
+
+    def _similarity(self, grams: set, product_id: int) -> float:
+        other = self._trigrams[product_id]
+        return len(grams & other) / len(grams | other)
+
+    def _match_or_add(self, normalized: str) -> int:
+        grams = trigrams(normalized)
+        best_id, best_score = None, 0.0
+        for pid, _ in self._candidates(grams).most_common(20):
+            score = self._similarity(grams, pid)
+            if score > best_score and compatible(normalized, self.products[pid]):
+                best_id, best_score = pid, score
+        if best_id is not None and best_score >= MATCH_THRESHOLD:
+            return best_id
+        return self._add_product(normalized, grams)
+
+    def _add_product(self, canonical: str, grams: set) -> int:
+        product_id = len(self.products)
+        self.products.append(canonical)
+        self._product_ids.setdefault(canonical, product_id)
+        self._trigrams.append(grams)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(product_id)
+        return product_id
+
+    # ------------------------------------------------------------------
+
+    def _read(self) -> Optional[Dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning("⚠️ Could not load item index from %s: %s", self.path, e)
+            return None
+
+    def _merge(self, data: Dict):
+        """Add products and raw names from a saved index, mapped onto local ids by canonical name"""
+        products = data.get("products", [])
+        with self._lock:
+            for canonical in products:
+                if canonical not in self._product_ids:
+                    self._add_product(canonical, trigrams(canonical))
+            for raw_name, product_id in data.get("raw_to_product", {}).items():
+                if raw_name not in self.raw_to_product and 0 <= product_id < len(products):
+                    self.raw_to_product[raw_name] = self._product_ids[products[product_id]]
+
+    def _load(self):
+        data = self._read()
+        if data:
+            self._merge(data)
+            logger.info("🔤 Loaded item index: %d products, %d raw names", len(self.products), len(self.raw_to_product))
+
+    def save(self):
+        """
+        Merge what other workers saved since, then rewrite the file - under a
+        file lock, so concurrent saves never drop each other's names
+        """
+        if not self.path:
+            return
+        try:
+            with file_lock(self.path):
+                data = self._read()
+                if data:
+                    self._merge(data)
+                with self._lock:
+                    payload = {"products": list(self.products), "raw_to_product": dict(self.raw_to_product)}
+                    self._dirty = False
+                write_json_atomic(self.path, payload)
+        except OSError as e:
+            self._dirty = True
+            logger.warning("⚠️ Could not save item index to %s: %s", self.path, e)
+
+    def save_if_changed(self) -> bool:
+        """Save only when raw names were added since the last save"""
+        if not self._dirty:
+            return False
+        self.save()
+        return True
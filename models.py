@@ -0,0 +1,139 @@
+"""
+Typed receipt model - compact slotted records that replace the free-form
+dicts passed between the parser, the API and Google Sheets
+"""
+import secrets
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+def generate_receipt_id() -> str:
+    """Id for a receipt the model returned without one: timestamp plus a random suffix,
+    so receipts parsed in the same second (several workers) never share an id"""
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(3)}"
+
+
+@dataclass(slots=True)
+class LineItem:
+    """One charge on a receipt (product, tax, fee or deposit)"""
+    name: str
+    quantity: int = 1
+    unit_price: float = 0.0
+    line_total: Optional[float] = None
+    category: str = "product"
+    notes: Optional[str] = None
+    # Filled in by the item normalization index
+    canonical_name: Optional[str] = None
+    size: Optional[float] = None
+    unit: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "LineItem":
+        return cls(
+            name=data.get("name") or "",
+            quantity=data.get("quantity", 1),
+            unit_price=data.get("unit_price") or 0.0,
+            line_total=data.get("line_total"),
+            category=data.get("category") or "product",
+            notes=data.get("notes"),
+            canonical_name=data.get("canonical_name"),
+            size=data.get("size"),
+            unit=data.get("unit"),
+        )
+
+    def to_dict(self) -> Dict:
+        item = {
+            "name": self.name,
+            "quantity": self.quantity,
+            "unit_price": self.unit_price,
+            "line_total": self.line_total,
+            "category": self.category,
+        }
+        if self.notes is not None:
+            item["notes"] = self.notes
+        if self.canonical_name is not None:
+            item["canonical_name"] = self.canonical_name
+            item["size"] = self.size
+            item["unit"] = self.unit
+        return item
+
+
+@dataclass(slots=True)
+class Receipt:
+    """A parsed receipt with its line items"""
+    receipt_id: str
+    store_name: Optional[str] = None
+    address: Optional[str] = None
+    phone: Optional[str] = None
+    date: Optional[str] = None
+    time: Optional[str] = None
+    cashier: Optional[str] = None
+    subtotal: float = 0.0
+    total: float = 0.0
+    tax: Optional[float] = None
+    payment_method: Optional[str] = None
+    card_last_4: Optional[str] = None
+    raw_text: Optional[str] = None
+    items: List[LineItem] = field(default_factory=list)
+    # Token/cost accounting of the parse that produced this receipt
+    usage: Optional[Dict] = None
+
+    @property
+    def item_count(self) -> int:
+        return len(self.items)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Receipt":
+        """Build from the parser's JSON shape (unknown keys are ignored)"""
+        return cls(
+            receipt_id=data.get("receipt_id") or generate_receipt_id(),
+            store_name=data.get("store_name"),
+            address=data.get("address"),
+            phone=data.get("phone"),
+            date=data.get("date"),
+            time=data.get("time"),
+            cashier=data.get("cashier"),
+            subtotal=data.get("subtotal") or 0.0,
+            total=data.get("total") or 0.0,
+            tax=data.get("tax"),
+            payment_method=data.get("payment_method"),
+            card_last_4=data.get("card_last_4"),
+            raw_text=data.get("raw_text"),
+            items=[LineItem.from_dict(item) for item in data.get("items") or []],
+            usage=data.get("usage"),
+        )
+
+    def to_dict(self) -> Dict:
+        """Full JSON representation, same shape the parser always returned (plus usage)"""
+        data = {
+            "receipt_id": self.receipt_id,
+            "store_name": self.store_name,
+            "address": self.address,
+            "phone": self.phone,
+            "date": self.date,
+            "time": self.time,
+            "cashier": self.cashier,
+            "subtotal": self.subtotal,
+            "total": self.total,
+            "payment_method": self.payment_method,
+            "card_last_4": self.card_last_4,
+            "items": [item.to_dict() for item in self.items],
+            "item_count": len(self.items),
+        }
+        if self.usage is not None:
+            data["usage"] = self.usage
+        return data
+
+    def to_summary(self) -> Dict:
+        """Compact payload returned by the API"""
+        return {
+            "receipt_id": self.receipt_id,
+            "store_name": self.store_name,
+            "date": self.date,
+            "total": self.total,
+            "payment_method": self.payment_method,
+            "card_last_4": self.card_last_4,
+            "item_count": len(self.items),
+            "usage": self.usage,
+        }
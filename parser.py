@@ -3,10 +3,16 @@ Enhanced parser - extracts quantity, unit price, and taxes
 """
 import os
 import base64
+import dataclasses
+import glob
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from PIL import Image
-import io
+import logging
+import time
 
 try:
     from dotenv import load_dotenv
@@ -16,43 +22,92 @@ except ImportError:
 
 import anthropic
 
+import validation
+from image_format import open_image, prepare_image
+from logging_setup import configure_logging
+from models import Receipt, generate_receipt_id
+from recorder import make_recorder
+from resilience import AdaptiveLimiter, CircuitBreaker, VisionGuard, VisionUnavailableError
+from shared_state import ResultCache, SharedLimiter, get_shared_state
+from store_templates import StoreTemplateCache
+from usage import BudgetPolicy, ParsePlan, ParseUsage, UsageLedger
+import tiling
+
 client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+VISION_MODEL = os.getenv("VISION_MODEL", "claude-sonnet-4-20250514")
+
+# Token/cost accounting per day and client, and the budgets that downshift
+# max_tokens, image size and model as they fill up (0 = unlimited)
+usage_ledger = UsageLedger(os.getenv("USAGE_DB_PATH", "usage.db"))
+budget = BudgetPolicy(
+    usage_ledger,
+    model=VISION_MODEL,
+    fallback_model=os.getenv("VISION_FALLBACK_MODEL", "claude-3-5-haiku-20241022"),
+    daily_usd=float(os.getenv("DAILY_BUDGET_USD", "0")),
+    client_daily_usd=float(os.getenv("CLIENT_DAILY_BUDGET_USD", "0")),
+    downshift_at=float(os.getenv("BUDGET_DOWNSHIFT_AT", "0.8")),
+    minimal_at=float(os.getenv("BUDGET_MINIMAL_AT", "0.95")),
+    hard_stop=os.getenv("BUDGET_HARD_STOP", "1") == "1",
+)
+
+# Raw responses for offline replay (RECORD_RESPONSES_PATH=recordings.jsonl)
+recorder = make_recorder(os.getenv("RECORD_RESPONSES_PATH"))
+
+# Host-wide state shared by all workers (SHARED_STATE=1), else None
+shared_state = get_shared_state()
+
+limiter_settings = dict(
+    initial=int(os.getenv("VISION_INITIAL_CONCURRENCY", "4")),
+    max_limit=int(os.getenv("VISION_MAX_CONCURRENCY", "32")),
+    latency_target=float(os.getenv("VISION_LATENCY_TARGET_S", "120")),
+    latency_tolerance=float(os.getenv("VISION_LATENCY_TOLERANCE", "2")),
+    queue_timeout=float(os.getenv("VISION_QUEUE_TIMEOUT_S", "60")),
+)
+
+# Shared admission control for every vision call made by this process
+# (and by every other worker on the host when shared state is on)
+vision_guard = VisionGuard(
+    SharedLimiter(shared_state, **limiter_settings) if shared_state else AdaptiveLimiter(**limiter_settings),
+    CircuitBreaker(
+        failure_threshold=int(os.getenv("VISION_BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("VISION_BREAKER_RESET_S", "30")),
+        open_wait=float(os.getenv("VISION_BREAKER_WAIT_S", "0")),
+    ),
+)
+
+# Per-store prompt templates learned from earlier receipts. The header hash alone
+# cannot tell text-only headers apart (a wrong candidate costs a second vision
+# call), so templates are on by default only when OCR identification is available.
+store_cache = StoreTemplateCache(
+    path=os.getenv("STORE_TEMPLATES_PATH", "store_profiles.json"),
+    use_ocr=os.getenv("STORE_ID_OCR", "0") == "1",
+)
+STORE_TEMPLATES_ENABLED = os.getenv("STORE_TEMPLATES", "1" if store_cache.use_ocr else "0") == "1"
+
+# Parsed results keyed by image hash; only available with shared state
+result_cache = (
+    ResultCache(shared_state, ttl=float(os.getenv("RESULT_CACHE_TTL_S", str(7 * 24 * 3600))))
+    if shared_state else None
+)
+
+# "auto" splits tall receipts into tiles parsed concurrently; "off" never does
+TILE_MODE = os.getenv("TILE_MODE", "off")
+TILE_WORKERS = int(os.getenv("TILE_WORKERS", "4"))
+
+logger = logging.getLogger(__name__)
 
 
 def compress_image_smart(image_bytes: bytes) -> bytes:
     """Smart compression that maintains text readability"""
-    target_size = 4 * 1024 * 1024
-    
-    if len(image_bytes) <= target_size:
-        print(f"   ✓ Image OK: {len(image_bytes) / 1024 / 1024:.2f} MB")
-        return image_bytes
-    
-    print(f"   📦 Compressing: {len(image_bytes) / 1024 / 1024:.2f} MB")
-    
-    image = Image.open(io.BytesIO(image_bytes))
-    
-    if image.mode in ('RGBA', 'P', 'LA'):
-        image = image.convert('RGB')
-    
-    ratio = (target_size / len(image_bytes)) ** 0.5
-    new_size = (int(image.width * ratio * 0.95), int(image.height * ratio * 0.95))
-    image = image.resize(new_size, Image.Resampling.LANCZOS)
-    
-    output = io.BytesIO()
-    image.save(output, format='JPEG', quality=92, optimize=True)
-    
-    result = output.getvalue()
-    print(f"   ✓ Compressed: {len(result) / 1024 / 1024:.2f} MB")
-    return result
+    return prepare_image(image_bytes)[0]
 
 
-def parse_receipt_image(image_bytes: bytes) -> dict:
-    """Parse receipt with enhanced item details including quantity and tax"""
-    
-    image_bytes = compress_image_smart(image_bytes)
-    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-    
-    prompt = """
+def encode_base64(data: bytes) -> str:
+    """The one base64 encode per image; the intermediate bytes are freed at once"""
+    return base64.b64encode(data).decode("ascii")
+
+
+RECEIPT_PROMPT = """
     You are an epxert OCR system that reads receipts for ANY store with PERECT accuracy.
     Your task: Extract ALL information from this receipt with 100% accuracy.
     
@@ -338,12 +393,24 @@ NOW: Analyze this receipt and return ONLY valid JSON.
 Remember: Include tax, fees, and deposits as line items!
 """
 
-    try:
-        print("🔍 Analyzing receipt with Claude Vision API...")
-        
+
+def request_receipt_json(image_base64: str, prompt: str, max_tokens: int = 8000,
+                         prompt_kind: str = "generic", plan: Optional[ParsePlan] = None,
+                         usage: Optional[ParseUsage] = None, media_type: str = "image/jpeg",
+                         image_sha256: Optional[str] = None) -> Dict:
+    """
+    One vision call; returns the raw receipt dict parsed from the model's JSON.
+    image_sha256 (of the uploaded bytes) only tags the recording.
+    """
+    model = plan.model if plan else VISION_MODEL
+    if plan:
+        max_tokens = min(max_tokens, plan.max_tokens)
+    with vision_guard.slot() as call:
+        # Timed inside the slot so recorded latency excludes limiter queueing
+        start = time.monotonic()
         message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=8000,
+            model=model,
+            max_tokens=max_tokens,
             messages=[{
                 "role": "user",
                 "content": [
@@ -351,7 +418,7 @@ Remember: Include tax, fees, and deposits as line items!
                         "type": "image",
                         "source": {
                             "type": "base64",
-                            "media_type": "image/jpeg",
+                            "media_type": media_type,
                             "data": image_base64,
                         },
                     },
@@ -359,32 +426,193 @@ Remember: Include tax, fees, and deposits as line items!
                 ],
             }],
         )
+        latency = time.monotonic() - start
+        call["output_tokens"] = getattr(getattr(message, "usage", None), "output_tokens", 0) or 0
+    
+    if usage is not None:
+        usage.add(model, message, latency)
+    response_text = message.content[0].text.strip()
+    if recorder is not None:
+        recorder.record(image_base64, prompt_kind, prompt, model, response_text, latency, message, image_sha256)
+    
+    # Extract JSON
+    json_text = extract_json_from_response(response_text)
+    
+    # Parse JSON
+    try:
+        return json.loads(json_text)
+    except json.JSONDecodeError as e:
+        logger.error("❌ JSON Parse Error: %s (response preview: %.500s...)", e, response_text)
+        raise
+
+
+def finalize_receipt(parsed_data: Dict, **log_fields) -> Receipt:
+    """Validate and enrich a parsed receipt dict, convert it and log the summary"""
+    parsed_data = validate_and_enrich_v2(parsed_data)
+    receipt = Receipt.from_dict(parsed_data)
+    
+    # Display summary
+    logger.info(
+        "✅ Parsed receipt %s: %s, %d items, total %s",
+        receipt.receipt_id, receipt.store_name, receipt.item_count, receipt.total,
+        extra={"receipt_id": receipt.receipt_id, "store_name": receipt.store_name,
+               "item_count": receipt.item_count, "total": receipt.total, **log_fields},
+    )
+    display_parsing_summary_v2(receipt)
+    
+    return receipt
+
+
+def request_tiled_receipt_json(image: Image.Image, plan: Optional[ParsePlan] = None,
+                               usage: Optional[ParseUsage] = None, image_sha256: Optional[str] = None) -> Dict:
+    """
+    Header/footer fields from one small call and items from overlapping
+    tiles, all requested concurrently, then merged into one receipt dict
+    """
+    header_jpeg, tiles = tiling.split_receipt(image, max_edge=plan.max_edge if plan else None)
+    logger.info("🧩 Tall receipt: parsing %d tiles + header/footer in parallel", len(tiles))
+    
+    with ThreadPoolExecutor(max_workers=TILE_WORKERS) as pool:
+        header_future = pool.submit(
+            request_receipt_json, encode_base64(header_jpeg), tiling.HEADER_FOOTER_PROMPT, 1000, "tile_header", plan, usage,
+            image_sha256=image_sha256,
+        )
+        tile_futures = [
+            pool.submit(
+                request_receipt_json, encode_base64(tile), tiling.TILE_ITEMS_PROMPT,
+                prompt_kind="tile_items", plan=plan, usage=usage, image_sha256=image_sha256,
+            )
+            for tile in tiles
+        ]
         
-        response_text = message.content[0].text.strip()
+        parsed = header_future.result()
+        tile_items = [future.result().get("items") or [] for future in tile_futures]
+    
+    parsed["items"] = tiling.merge_tile_items(tile_items)
+    logger.debug(
+        "🧩 Merged %d tile items into %d", sum(len(items) for items in tile_items), len(parsed["items"])
+    )
+    return parsed
+
+
+def parse_tiled_receipt(image_bytes: bytes, plan: Optional[ParsePlan] = None,
+                        usage: Optional[ParseUsage] = None, image_sha256: Optional[str] = None) -> Receipt:
+    """Parse a long receipt as tiles; the merged items are reconciled as usual"""
+    image = open_image(image_bytes)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return finalize_receipt(request_tiled_receipt_json(image, plan, usage, image_sha256), tiled=True)
+
+
+def parse_receipt_image(image_bytes: bytes, tiled: Optional[bool] = None, client: str = "default") -> Receipt:
+    """
+    Parse receipt with enhanced item details including quantity and tax.
+    tiled=None follows TILE_MODE; True/False forces tiling on or off.
+    Token usage is attached to the receipt and charged to `client`; raises
+    BudgetExceededError when the client's daily budget is spent.
+    """
+    start = time.monotonic()
+    # Upload hash: the result cache key, and what recordings are joined on
+    key = hashlib.sha256(image_bytes).hexdigest() if result_cache is not None or recorder is not None else None
+    cached = result_cache.get(key) if key and result_cache is not None else None
+    if cached is not None:
+        logger.info("♻️  Result cache hit, skipping the vision call", extra={"image_sha256": key[:12]})
+        receipt = Receipt.from_dict(cached)
+        usage = ParseUsage(client, tier="cached")
+        usage.cached = True
+    else:
+        plan = budget.plan(client)
+        usage = ParseUsage(client, tier=plan.tier)
+        try:
+            receipt = _parse_receipt_image(image_bytes, tiled, plan, usage, key)
+        except Exception:
+            # Calls made before the failure are still billed
+            usage.wall_time_s = time.monotonic() - start
+            usage_ledger.record(usage)
+            raise
+        # Only full-tier results are cached: an economy/minimal parse would be replayed
+        # for the whole TTL, long after the budget resets
+        if result_cache is not None and receipt.items and plan.tier == "full":
+            result_cache.put(key, dataclasses.asdict(receipt))
+
+    usage.wall_time_s = time.monotonic() - start
+    usage_ledger.record(usage)
+    receipt.usage = usage.to_dict()
+    logger.info(
+        "🪙 Usage: %d call(s), %d in / %d out tokens, $%.4f, %.1fs",
+        usage.calls, usage.input_tokens, usage.output_tokens, usage.cost_usd, usage.wall_time_s,
+        extra={"receipt_id": receipt.receipt_id, "cost_usd": round(usage.cost_usd, 6), "tier": usage.tier},
+    )
+    return receipt
+
+
+def _parse_receipt_image(image_bytes: bytes, tiled: Optional[bool], plan: ParsePlan, usage: ParseUsage,
+                         image_sha256: Optional[str] = None) -> Receipt:
+    if tiled is None and TILE_MODE == "auto":
+        try:
+            original = open_image(image_bytes)
+            tiled = tiling.should_tile(original)
+        except Exception:
+            tiled = False
+    if tiled:
+        try:
+            return parse_tiled_receipt(image_bytes, plan, usage, image_sha256)
+        except VisionUnavailableError:
+            raise
+        except Exception as e:
+            logger.warning("↩️  Tiled parse failed (%s), retrying as a single image", e)
+    
+    image_bytes, media_type = prepare_image(image_bytes, plan.max_edge)
+    image_base64 = encode_base64(image_bytes)
+    
+    # Cheap merchant lookup from the header band picks a short store prompt
+    fp, store = store_cache.identify(image_bytes) if STORE_TEMPLATES_ENABLED else (None, None)
+
+    try:
+        logger.info("🔍 Analyzing receipt with Claude Vision API...")
+        start = time.monotonic()
         
-        # Extract JSON
-        json_text = extract_json_from_response(response_text)
+        parsed_data = None
+        if store:
+            try:
+                parsed_data = request_receipt_json(
+                    image_base64, store_cache.build_prompt(store), prompt_kind="store",
+                    plan=plan, usage=usage, media_type=media_type, image_sha256=image_sha256,
+                )
+            except json.JSONDecodeError:
+                parsed_data = None
+            if not parsed_data or not parsed_data.get("items"):
+                logger.info("↩️  %s template found no items, retrying with the generic prompt", store)
+                parsed_data = None
+            elif not store_cache.confirmed(store, parsed_data):
+                # Wrong header match: the store hints may have skewed extraction
+                logger.info("↩️  Header matched %s but the receipt reads %r, retrying with the generic prompt",
+                            store, parsed_data.get("store_name"))
+                parsed_data = None
+        used_template = parsed_data is not None
         
-        # Parse JSON
-        parsed_data = json.loads(json_text)
+        if parsed_data is None:
+            parsed_data = request_receipt_json(
+                image_base64, RECEIPT_PROMPT, plan=plan, usage=usage, media_type=media_type,
+                image_sha256=image_sha256,
+            )
         
-        # Validate and enrich
-        parsed_data = validate_and_enrich_v2(parsed_data)
+        receipt = finalize_receipt(parsed_data, store_template=store if used_template else None)
         
-        # Display summary
-        display_parsing_summary_v2(parsed_data)
+        if STORE_TEMPLATES_ENABLED:
+            store_cache.observe(store, fp, receipt, used_template, time.monotonic() - start)
         
-        return parsed_data
+        return receipt
         
-    except json.JSONDecodeError as e:
-        print(f"❌ JSON Parse Error: {e}")
-        print(f"Response preview: {response_text[:500]}...")
-        return create_empty_result()
+    except json.JSONDecodeError:
+        return Receipt.from_dict(create_empty_result())
+    except VisionUnavailableError as e:
+        # Don't turn an outage into an empty "No items detected" receipt
+        logger.error("❌ Vision API unavailable: %s", e)
+        raise
     except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
-        return create_empty_result()
+        logger.exception("❌ Error: %s", e)
+        return Receipt.from_dict(create_empty_result())
 
 
 def extract_json_from_response(response_text: str) -> str:
@@ -410,119 +638,122 @@ def extract_json_from_response(response_text: str) -> str:
     return json_text
 
 
+RECEIPT_DEFAULTS = {
+    "store_name": None,
+    "address": None,
+    "phone": None,
+    "date": None,
+    "time": None,
+    "cashier": None,
+    "subtotal": 0.0,
+    "total": 0.0,
+    "payment_method": None,
+    "card_last_4": None,
+}
+
+
+def apply_receipt_defaults(data: Dict) -> Dict:
+    """Fill in missing top-level receipt fields"""
+    if not data.get("receipt_id"):
+        data["receipt_id"] = generate_receipt_id()
+    for key, value in RECEIPT_DEFAULTS.items():
+        data.setdefault(key, value)
+    if data.get("items") is None:
+        data["items"] = []
+    return data
+
+
 def validate_and_enrich_v2(data: Dict) -> Dict:
     """Validate and enrich - NEW VERSION with all items included"""
-    
-    # Set defaults
-    data.setdefault("receipt_id", datetime.now().strftime("%Y%m%d%H%M%S"))
-    data.setdefault("store_name", None)
-    data.setdefault("address", None)
-    data.setdefault("phone", None)
-    data.setdefault("date", None)
-    data.setdefault("time", None)
-    data.setdefault("cashier", None)
-    data.setdefault("subtotal", 0.0)
-    data.setdefault("total", 0.0)
-    data.setdefault("payment_method", None)
-    data.setdefault("card_last_4", None)
-    data.setdefault("items", [])
-    
-    # Validate items
-    valid_items = []
-    total_from_items = 0.0
-    product_subtotal = 0.0
-    
-    for item in data["items"]:
-        if not item.get("name"):
-            continue
-        
-        # Ensure fields
-        quantity = item.get("quantity", 1)
-        line_total = item.get("line_total", 0.0)
-        category = item.get("category", "product")
-        
-        # Auto-calculate unit_price
-        if not item.get("unit_price") or item.get("unit_price") == 0:
-            item["unit_price"] = round(line_total / quantity, 2) if quantity > 0 else line_total
-        
-        # Ensure types
-        item["quantity"] = int(quantity)
-        item["unit_price"] = float(item["unit_price"])
-        item["line_total"] = float(line_total)
-        item["category"] = category
-        
-        valid_items.append(item)
-        total_from_items += line_total
-        
-        # Track product-only subtotal (excluding tax)
-        if category in ["product", "fee", "deposit"]:
-            product_subtotal += line_total
-    
-    data["items"] = valid_items
-    data["item_count"] = len(valid_items)
-    
-    # Validate total = sum of all items
-    receipt_total = float(data.get("total", 0))
-    if abs(total_from_items - receipt_total) > 0.10:
-        print(f"\n⚠️  WARNING: Total mismatch!")
-        print(f"   Sum of all items: ${total_from_items:.2f}")
-        print(f"   Receipt total: ${receipt_total:.2f}")
-        print(f"   Difference: ${abs(total_from_items - receipt_total):.2f}")
-    
-    # Info: show breakdown
-    tax_items = [i for i in valid_items if i.get("category") == "tax"]
-    fee_items = [i for i in valid_items if i.get("category") in ["fee", "deposit"]]
-    product_items = [i for i in valid_items if i.get("category") == "product"]
-    
-    total_tax = sum(i["line_total"] for i in tax_items)
-    total_fees = sum(i["line_total"] for i in fee_items)
-    total_products = sum(i["line_total"] for i in product_items)
-    
-    print(f"\n📊 BREAKDOWN:")
-    print(f"   Products: ${total_products:.2f} ({len(product_items)} items)")
-    print(f"   Fees/Deposits: ${total_fees:.2f} ({len(fee_items)} items)")
-    print(f"   Tax: ${total_tax:.2f} ({len(tax_items)} items)")
-    print(f"   TOTAL: ${total_from_items:.2f}")
-    
+    reconcile_receipt(data)
     return data
 
 
-def display_parsing_summary_v2(data: Dict):
-    """Display formatted summary - includes all items"""
-    print(f"\n{'='*80}")
-    print(f"📊 RECEIPT PARSING SUMMARY")
-    print(f"{'='*80}")
-    print(f"Store:        {data.get('store_name', 'Unknown')}")
-    print(f"Date:         {data.get('date', 'Unknown')}")
-    print(f"Receipt ID:   {data.get('receipt_id', 'Unknown')}")
-    print(f"Total Items:  {data.get('item_count', 0)}")
-    print(f"Total:        ${data.get('total', 0):.2f}")
-    print(f"Payment:      {data.get('payment_method', 'Unknown')}")
-    
-    print(f"\n📝 ALL LINE ITEMS (Products + Tax + Fees + Deposits):")
-    print(f"{'-'*80}")
-    print(f"{'#':<3} {'Item Name':<45} {'Qty':>3} {'Price':>8} {'Total':>9} {'Type':<10}")
-    print(f"{'-'*80}")
-    
-    for idx, item in enumerate(data.get('items', []), 1):
-        qty = item['quantity']
-        unit_price = item['unit_price']
-        line_total = item['line_total']
-        name = item['name'][:44]
-        category = item.get('category', 'product')
+def reconcile_receipt(data: Dict) -> Dict:
+    """validate_and_enrich_v2, returning the breakdown (with the mismatch verdict) instead of the dict"""
+    apply_receipt_defaults(data)
+
+    # Single pass over the items, money reconciled in integer cents
+    breakdown = validation.validate_receipt(data)
+
+    # Validate total = sum of all items
+    if breakdown["mismatch"]:
+        logger.warning(
+            "⚠️  Total mismatch! Sum of all items: $%.2f, receipt total: $%.2f, difference: $%.2f",
+            breakdown["items_total"], breakdown["receipt_total"], breakdown["difference"],
+            extra={"receipt_id": data["receipt_id"], "difference": breakdown["difference"]},
+        )
+
+    # Debug: show breakdown
+    logger.debug(
+        "📊 Breakdown: products $%.2f (%d items), fees/deposits $%.2f (%d items), tax $%.2f (%d items), total $%.2f",
+        breakdown["products"], breakdown["product_count"], breakdown["fees"], breakdown["fee_count"],
+        breakdown["tax"], breakdown["tax_count"], breakdown["items_total"],
+    )
+
+    return breakdown
+
+
+def validate_and_enrich_batch(receipts: List[Dict]) -> Tuple[validation.ItemBatch, validation.Reconciliation]:
+    """
+    Validate and reconcile many receipts at once (bulk backfills).
+    Returns the item arrays and per-receipt reconciliation; the dicts are
+    not modified - writing values back costs more than the arrays save.
+    """
+    batch, summary = validation.validate_batch(receipts)
+
+    mismatched = int(summary.mismatch.sum())
+    if mismatched:
+        logger.warning("⚠️  %d/%d receipts have a total mismatch", mismatched, len(receipts))
+
+    return batch, summary
+
+
+def display_parsing_summary_v2(receipt: Receipt):
+    """Log the formatted summary table - only rendered at DEBUG level"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    
+    lines = [
+        "",
+        "=" * 80,
+        "📊 RECEIPT PARSING SUMMARY",
+        "=" * 80,
+        f"Store:        {receipt.store_name}",
+        f"Date:         {receipt.date}",
+        f"Receipt ID:   {receipt.receipt_id}",
+        f"Total Items:  {receipt.item_count}",
+        f"Total:        ${receipt.total:.2f}",
+        f"Payment:      {receipt.payment_method}",
+        "",
+        "📝 ALL LINE ITEMS (Products + Tax + Fees + Deposits):",
+        "-" * 80,
+        f"{'#':<3} {'Item Name':<45} {'Qty':>3} {'Price':>8} {'Total':>9} {'Type':<10}",
+        "-" * 80,
+    ]
+    
+    for idx, item in enumerate(receipt.items, 1):
+        qty = item.quantity
+        unit_price = item.unit_price
+        line_total = item.line_total
+        name = item.name[:44]
+        category = item.category
         
         if qty > 1:
-            print(f"{idx:<3} {name:<45} {qty:>3} ${unit_price:>7.2f} ${line_total:>8.2f} {category:<10}")
+            lines.append(f"{idx:<3} {name:<45} {qty:>3} ${unit_price:>7.2f} ${line_total:>8.2f} {category:<10}")
         else:
-            print(f"{idx:<3} {name:<45} {qty:>3}          ${line_total:>8.2f} {category:<10}")
+            lines.append(f"{idx:<3} {name:<45} {qty:>3}          ${line_total:>8.2f} {category:<10}")
+    
+    lines.append("=" * 80)
     
-    print(f"{'='*80}\n")
+    # One record for the whole table so concurrent requests don't interleave
+    logger.debug("\n".join(lines))
 
 
 def create_empty_result() -> Dict:
     """Create empty result structure"""
     return {
-        "receipt_id": datetime.now().strftime("%Y%m%d%H%M%S"),
+        "receipt_id": generate_receipt_id(),
         "store_name": None,
         "address": None,
         "phone": None,
@@ -538,79 +769,178 @@ def create_empty_result() -> Dict:
     }
 
 
-def batch_process_receipts(image_paths: List[str]) -> List[Dict]:
-    """Process multiple receipts in batch"""
-    results = []
-    total = len(image_paths)
-    
-    print(f"\n{'='*80}")
-    print(f"🔄 BATCH PROCESSING {total} RECEIPTS")
-    print(f"{'='*80}\n")
-    
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".heic", ".heif"}
+
+
+def iter_image_paths(inputs: Iterable[str]) -> Iterator[str]:
+    """Lazily expand files, directories and glob patterns into image paths"""
+    for entry in inputs:
+        if os.path.isdir(entry):
+            with os.scandir(entry) as it:
+                for dirent in it:
+                    if dirent.is_file() and os.path.splitext(dirent.name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield dirent.path
+        elif glob.has_magic(entry):
+            for path in glob.iglob(entry, recursive=True):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield entry
+
+
+def iter_batch_results(image_paths: Iterable[str], skip: Set[str] = frozenset()) -> Iterator[Dict]:
+    """Process receipts one at a time, yielding each result as soon as it is done"""
     for idx, path in enumerate(image_paths, 1):
-        print(f"\n[{idx}/{total}] Processing: {path}")
-        print(f"{'-'*80}")
+        if os.path.normpath(path) in skip:
+            logger.debug("⏭️  Skipping (already processed): %s", path)
+            continue
+
+        logger.info("[%d] Processing: %s", idx, path)
         
         try:
             with open(path, 'rb') as f:
                 image_bytes = f.read()
             
-            result = parse_receipt_image(image_bytes)
-            results.append({
+            receipt = parse_receipt_image(image_bytes, client="batch")
+            yield {
                 "file": path,
                 "success": True,
-                "data": result
-            })
+                "data": receipt
+            }
             
         except Exception as e:
-            print(f"❌ Failed to process {path}: {e}")
-            results.append({
+            logger.error("❌ Failed to process %s: %s", path, e)
+            yield {
                 "file": path,
                 "success": False,
                 "error": str(e)
-            })
+            }
+
+
+def batch_process_receipts(image_paths: List[str]) -> List[Dict]:
+    """Process multiple receipts in batch"""
+    total = len(image_paths)
+    
+    logger.info("🔄 BATCH PROCESSING %d RECEIPTS", total)
+    
+    results = list(iter_batch_results(image_paths))
     
     # Summary
     successful = sum(1 for r in results if r["success"])
-    print(f"\n{'='*80}")
-    print(f"✅ Batch Complete: {successful}/{total} receipts processed successfully")
-    print(f"{'='*80}\n")
+    logger.info("✅ Batch Complete: %d/%d receipts processed successfully", successful, total)
     
     return results
 
 
+def batch_record_to_json(record: Dict) -> Dict:
+    """Serialize a batch result, converting the Receipt to plain JSON"""
+    if record["success"]:
+        return {**record, "data": record["data"].to_dict()}
+    return record
+
+
+def load_processed_files(output_file: str) -> Set[str]:
+    """Files already processed successfully in an existing JSONL output"""
+    done = set()
+    if not os.path.exists(output_file):
+        return done
+    
+    with open(output_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partial last line from an interrupted run
+                continue
+            if record.get("success"):
+                done.add(os.path.normpath(record["file"]))
+    return done
+
+
+def drop_partial_last_line(output_file: str) -> int:
+    """
+    Truncate output_file back to its last newline, so appends never glue
+    onto a line cut off by a crash. Returns the number of bytes dropped.
+    """
+    if not os.path.exists(output_file):
+        return 0
+    with open(output_file, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+    if end < size:
+        logger.warning("✂️  Dropped %d byte(s) of a partial last line in %s", size - end, output_file)
+    return size - end
+
+
+def stream_batch_to_jsonl(image_paths: Iterable[str], output_file: str, resume: bool = False) -> Dict:
+    """
+    Process receipts lazily and append one JSON line per receipt as it completes.
+    With resume=True, files already recorded as successful in output_file are skipped.
+    """
+    if resume:
+        drop_partial_last_line(output_file)
+    skip = load_processed_files(output_file) if resume else set()
+    if skip:
+        logger.info("↩️  Resuming: %d receipt(s) already in %s", len(skip), output_file)
+    
+    counts = {"processed": 0, "successful": 0, "skipped": len(skip)}
+    with open(output_file, 'a' if resume else 'w') as f:
+        for record in iter_batch_results(image_paths, skip):
+            f.write(json.dumps(batch_record_to_json(record)) + "\n")
+            f.flush()
+            counts["processed"] += 1
+            counts["successful"] += record["success"]
+    
+    logger.info("✅ Batch Complete: %d/%d receipts processed successfully", counts["successful"], counts["processed"])
+    return counts
+
+
 if __name__ == "__main__":
-    import sys
-    
-    if len(sys.argv) < 2:
-        print("Usage:")
-        print("  Single receipt: python universal_parser_v2.py <image_path>")
-        print("  Multiple receipts: python universal_parser_v2.py <image1> <image2> ...")
-        sys.exit(1)
-    
-    image_paths = sys.argv[1:]
-    
-    if len(image_paths) == 1:
+    import argparse
+    
+    arg_parser = argparse.ArgumentParser(
+        description="Parse receipt images. One image prints its JSON; several images, "
+                    "directories or glob patterns are streamed to a JSONL file."
+    )
+    arg_parser.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    arg_parser.add_argument("-o", "--output", help="JSONL output file for batch mode")
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="skip files already recorded as successful in --output")
+    args = arg_parser.parse_args()
+    configure_logging()
+    
+    single = len(args.inputs) == 1 and os.path.isfile(args.inputs[0]) and not args.output
+    
+    if single:
         # Single receipt
-        print(f"\n🧪 Processing receipt: {image_paths[0]}\n")
+        logger.info("🧪 Processing receipt: %s", args.inputs[0])
         
-        with open(image_paths[0], 'rb') as f:
+        with open(args.inputs[0], 'rb') as f:
             image_bytes = f.read()
         
-        result = parse_receipt_image(image_bytes)
+        receipt = parse_receipt_image(image_bytes)
         
         print("\n" + "="*80)
         print("FULL JSON OUTPUT:")
         print("="*80)
-        print(json.dumps(result, indent=2))
+        print(json.dumps(receipt.to_dict(), indent=2))
         
     else:
-        # Batch processing
-        results = batch_process_receipts(image_paths)
+        if args.resume and not args.output:
+            arg_parser.error("--resume needs --output pointing at the previous run's JSONL file")
         
-        # Save results
-        output_file = f"batch_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(output_file, 'w') as f:
-            json.dump(results, f, indent=2)
+        # Batch processing, streamed to JSONL
+        output_file = args.output or f"batch_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+        stream_batch_to_jsonl(iter_image_paths(args.inputs), output_file, resume=args.resume)
         
-        print(f"📁 Batch results saved to: {output_file}")
+        logger.info("📁 Batch results saved to: %s", output_file)
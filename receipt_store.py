@@ -0,0 +1,262 @@
+"""
+Local receipt store - SQLite mirror of what append_to_sheet writes, with
+per-day/per-store spend aggregates maintained incrementally so queries
+never touch the Sheets API
+"""
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from store_templates import canonical_store_name
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id             INTEGER PRIMARY KEY AUTOINCREMENT,
+    receipt_id     TEXT NOT NULL,
+    written_at     TEXT NOT NULL,
+    store_name     TEXT,
+    store_key      TEXT NOT NULL,
+    date           TEXT NOT NULL,
+    total_cents    INTEGER NOT NULL,
+    tax_cents      INTEGER NOT NULL,
+    item_count     INTEGER NOT NULL,
+    payment_method TEXT,
+    card_last_4    TEXT,
+    address        TEXT
+);
+CREATE INDEX IF NOT EXISTS receipts_by_date ON receipts (date);
+CREATE INDEX IF NOT EXISTS receipts_by_store_date ON receipts (store_key, date);
+CREATE INDEX IF NOT EXISTS receipts_by_written ON receipts (receipt_id, written_at);
+
+CREATE TABLE IF NOT EXISTS items (
+    receipt_row      INTEGER NOT NULL REFERENCES receipts (id),
+    name             TEXT NOT NULL,
+    canonical_name   TEXT,
+    quantity         REAL,
+    unit_price_cents INTEGER,
+    line_total_cents INTEGER,
+    category         TEXT
+);
+CREATE INDEX IF NOT EXISTS items_by_receipt ON items (receipt_row);
+CREATE INDEX IF NOT EXISTS items_by_canonical ON items (canonical_name);
+
+CREATE TABLE IF NOT EXISTS daily_spend (
+    date        TEXT NOT NULL,
+    store_key   TEXT NOT NULL,
+    receipts    INTEGER NOT NULL,
+    total_cents INTEGER NOT NULL,
+    tax_cents   INTEGER NOT NULL,
+    PRIMARY KEY (date, store_key)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# Receipt date layouts seen besides ISO; US month-first before day-first
+DATE_FORMATS = ("%Y/%m/%d", "%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y", "%m-%d-%y", "%d.%m.%Y", "%d.%m.%y",
+                "%b %d, %Y", "%b %d %Y", "%d %b %Y", "%B %d, %Y", "%d %B %Y")
+
+
+def iso_date(value, written_at: str) -> str:
+    """
+    Receipt date as YYYY-MM-DD, so date filters and daily aggregates compare
+    correctly; unparseable dates, and dates after the write, fall back to
+    the day the receipt was written
+    """
+    text = str(value or "").strip()
+    parsed = None
+    try:
+        parsed = datetime.fromisoformat(text).date()
+    except ValueError:
+        for fmt in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(text, fmt).date()
+                break
+            except ValueError:
+                continue
+    fallback = written_at[:10]
+    if parsed is None or parsed.year < 2000 or parsed.isoformat() > fallback:
+        if text:
+            logger.debug("📅 Receipt date %r not usable, using write date %s", text, fallback)
+        return fallback
+    return parsed.isoformat()
+
+
+def _cents(value) -> int:
+    try:
+        return int(round(float(value or 0) * 100))
+    except (TypeError, ValueError):
+        return 0
+
+
+class ReceiptStore:
+    """Thread-safe SQLite store; one connection shared behind a lock"""
+
+    def __init__(self, path: str = "receipts.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def record(self, receipt, written_at: Optional[str] = None):
+        """Insert a receipt and its items and bump the daily aggregate in one transaction"""
+        try:
+            with self._lock, self._conn:
+                self._insert(receipt, written_at)
+        except sqlite3.Error as e:
+            # The sheet is the source of truth; a failed mirror write must not fail the request
+            logger.warning("⚠️ Could not record receipt %s in %s: %s", receipt.receipt_id, self.path, e)
+
+    def record_many(self, entries: List[Tuple[object, str]]) -> int:
+        """Bulk record (receipt, written_at) pairs in one transaction; returns rows inserted"""
+        with self._lock, self._conn:
+            return sum(self._insert(receipt, written_at) for receipt, written_at in entries)
+
+    def _insert(self, receipt, written_at: Optional[str]) -> bool:
+        written_at = written_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        receipt_id = receipt.receipt_id or "UNKNOWN"
+        total_cents = _cents(receipt.total)
+        # The same sheet write can reach us twice (live append, then a backfill import).
+        # written_at has one-second resolution, so the total (which the importer rebuilds
+        # from the Total row) tells apart different receipts that share an id and second.
+        if self._conn.execute(
+            "SELECT 1 FROM receipts WHERE receipt_id = ? AND written_at = ? AND total_cents = ?",
+            (receipt_id, written_at, total_cents),
+        ).fetchone():
+            return False
+
+        store_key = canonical_store_name(receipt.store_name) or "UNKNOWN"
+        date = iso_date(receipt.date, written_at)
+        tax_cents = sum(_cents(i.line_total) for i in receipt.items if i.category == "tax")
+
+        cursor = self._conn.execute(
+            "INSERT INTO receipts (receipt_id, written_at, store_name, store_key, date, total_cents,"
+            " tax_cents, item_count, payment_method, card_last_4, address)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (receipt_id, written_at, receipt.store_name, store_key, date,
+             total_cents, tax_cents, len(receipt.items), receipt.payment_method,
+             receipt.card_last_4, receipt.address),
+        )
+        self._conn.executemany(
+            "INSERT INTO items (receipt_row, name, canonical_name, quantity, unit_price_cents,"
+            " line_total_cents, category) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (cursor.lastrowid, i.name, i.canonical_name, i.quantity,
+                 _cents(i.unit_price), _cents(i.line_total), i.category)
+                for i in receipt.items
+            ],
+        )
+        self._conn.execute(
+            "INSERT INTO daily_spend (date, store_key, receipts, total_cents, tax_cents)"
+            " VALUES (?, ?, 1, ?, ?)"
+            " ON CONFLICT (date, store_key) DO UPDATE SET"
+            " receipts = receipts + 1,"
+            " total_cents = total_cents + excluded.total_cents,"
+            " tax_cents = tax_cents + excluded.tax_cents",
+            (date, store_key, total_cents, tax_cents),
+        )
+        return True
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _filters(store: Optional[str], date_from: Optional[str], date_to: Optional[str]):
+        clauses, params = [], []
+        if store:
+            clauses.append("store_key = ?")
+            params.append(canonical_store_name(store))
+        if date_from:
+            clauses.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            clauses.append("date <= ?")
+            params.append(date_to)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def list_receipts(self, store: Optional[str] = None, date_from: Optional[str] = None,
+                      date_to: Optional[str] = None, limit: int = 50, offset: int = 0) -> List[Dict]:
+        """Newest first, without items"""
+        where, params = self._filters(store, date_from, date_to)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT receipt_id, written_at, store_name, store_key, date, total_cents, tax_cents,"
+                " item_count, payment_method, card_last_4"
+                f" FROM receipts{where} ORDER BY date DESC, id DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return [
+            {
+                "receipt_id": row["receipt_id"],
+                "store_name": row["store_name"],
+                "store": row["store_key"],
+                "date": row["date"],
+                "total": row["total_cents"] / 100,
+                "tax": row["tax_cents"] / 100,
+                "item_count": row["item_count"],
+                "payment_method": row["payment_method"],
+                "card_last_4": row["card_last_4"],
+                "written_at": row["written_at"],
+            }
+            for row in rows
+        ]
+
+    def spend(self, store: Optional[str] = None, date_from: Optional[str] = None,
+              date_to: Optional[str] = None) -> Dict:
+        """Totals from the daily aggregates, broken down by store and by day"""
+        where, params = self._filters(store, date_from, date_to)
+        with self._lock:
+            by_store = self._conn.execute(
+                "SELECT store_key, SUM(receipts) AS receipts, SUM(total_cents) AS total_cents,"
+                f" SUM(tax_cents) AS tax_cents FROM daily_spend{where}"
+                " GROUP BY store_key ORDER BY total_cents DESC",
+                params,
+            ).fetchall()
+            by_day = self._conn.execute(
+                "SELECT date, SUM(receipts) AS receipts, SUM(total_cents) AS total_cents"
+                f" FROM daily_spend{where} GROUP BY date ORDER BY date",
+                params,
+            ).fetchall()
+        return {
+            "total": sum(row["total_cents"] for row in by_store) / 100,
+            "tax": sum(row["tax_cents"] for row in by_store) / 100,
+            "receipts": sum(row["receipts"] for row in by_store),
+            "by_store": [
+                {"store": row["store_key"], "receipts": row["receipts"], "total": row["total_cents"] / 100}
+                for row in by_store
+            ],
+            "by_day": [
+                {"date": row["date"], "receipts": row["receipts"], "total": row["total_cents"] / 100}
+                for row in by_day
+            ],
+        }
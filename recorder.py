@@ -0,0 +1,79 @@
+"""
+Opt-in recorder for raw vision responses - one JSONL line per API call with
+the uploaded image's hash, prompt version, model, raw text, latency and
+token usage, so parser changes can be replayed offline (see replay.py)
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=256)
+def prompt_version(prompt: str) -> str:
+    """Short content hash identifying the exact prompt text"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+
+class ResponseRecorder:
+    """Appends recordings to a JSONL file; safe to share between threads"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def record(self, image_base64: str, prompt_kind: str, prompt: str, model: str,
+               response_text: str, latency: float, message=None, image_sha256: Optional[str] = None):
+        """
+        image_sha256 is the hash of the uploaded bytes (the result cache key, and
+        what `sha256sum` gives for the source file); wire_sha256 identifies the
+        payload actually sent, which differs after conversion or tiling
+        """
+        usage = getattr(message, "usage", None)
+        entry = {
+            "ts": time.time(),
+            "image_sha256": image_sha256,
+            "wire_sha256": hashlib.sha256(image_base64.encode("ascii")).hexdigest(),
+            "prompt_kind": prompt_kind,
+            "prompt_version": prompt_version(prompt),
+            "model": model,
+            "latency_s": round(latency, 3),
+            "input_tokens": getattr(usage, "input_tokens", None),
+            "output_tokens": getattr(usage, "output_tokens", None),
+            "stop_reason": getattr(message, "stop_reason", None),
+            "response": response_text,
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        try:
+            with self._lock:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                self.recorded += 1
+        except OSError as e:
+            logger.warning("⚠️ Could not record vision response to %s: %s", self.path, e)
+
+
+def load_recordings(paths: Iterable[str]) -> Iterator[Dict]:
+    """Recordings from one or more JSONL files, skipping damaged lines"""
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("⚠️ Skipping damaged recording %s:%d", path, line_number)
+
+
+def make_recorder(path: Optional[str]) -> Optional[ResponseRecorder]:
+    if not path:
+        return None
+    logger.info("🎙️ Recording raw vision responses to %s", path)
+    return ResponseRecorder(path)
@@ -0,0 +1,100 @@
+"""
+Offline replay of recorded vision responses (see recorder.py) through the
+production post-processing (extract_json_from_response + validate_and_enrich_v2),
+comparing sum-match accuracy and latency between prompt versions or models
+
+Usage:
+  python replay.py recordings.jsonl [more.jsonl ...] [--by prompt_version|model|prompt_kind]
+"""
+import argparse
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Iterable
+
+import numpy as np
+
+from logging_setup import configure_logging
+from parser import extract_json_from_response, reconcile_receipt
+from recorder import load_recordings
+
+logger = logging.getLogger(__name__)
+
+# Prompt kinds whose response is a whole receipt (tile responses are partial)
+RECEIPT_KINDS = ("generic", "store")
+
+
+def replay_record(record: Dict) -> Dict:
+    """Re-extract the JSON of one recording; returns the parsed dict or None"""
+    try:
+        data = json.loads(extract_json_from_response(record.get("response") or ""))
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def replay(records: Iterable[Dict], by: str = "prompt_version") -> Dict[str, Dict]:
+    """Per-group parse rate, sum-match rate, latency and token stats"""
+    groups: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(list))
+    for record in records:
+        key = f"{record.get('prompt_kind', 'generic')}/{record.get(by) or 'unknown'}"
+        group = groups[key]
+        parsed = replay_record(record)
+        group["parsed"].append(parsed is not None)
+        if parsed is not None and record.get("prompt_kind", "generic") in RECEIPT_KINDS:
+            # The per-request validator, so replay reports what production computes
+            group["mismatch"].append(reconcile_receipt(parsed)["mismatch"])
+        if record.get("latency_s") is not None:
+            group["latency"].append(record["latency_s"])
+        if record.get("output_tokens") is not None:
+            group["output_tokens"].append(record["output_tokens"])
+
+    results = {}
+    for key, group in sorted(groups.items()):
+        latency = np.asarray(group["latency"], dtype=np.float64)
+        mismatch = group["mismatch"]
+        results[key] = {
+            "calls": len(group["parsed"]),
+            "parse_rate": float(np.mean(group["parsed"])),
+            "sum_match_rate": 1.0 - float(np.mean(mismatch)) if mismatch else None,
+            "latency_p50_s": float(np.percentile(latency, 50)) if latency.size else None,
+            "latency_p90_s": float(np.percentile(latency, 90)) if latency.size else None,
+            "latency_p99_s": float(np.percentile(latency, 99)) if latency.size else None,
+            "avg_output_tokens": float(np.mean(group["output_tokens"])) if group["output_tokens"] else None,
+        }
+    return results
+
+
+def _fmt(value, spec: str) -> str:
+    return "-" if value is None else format(value, spec)
+
+
+def print_report(results: Dict[str, Dict]):
+    print(f"{'group':40} {'calls':>7} {'parsed':>7} {'sum ok':>7} {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'out tok':>8}")
+    for key, r in results.items():
+        print(
+            f"{key:40} {r['calls']:7d} {_fmt(r['parse_rate'], '7.1%')} {_fmt(r['sum_match_rate'], '7.1%')} "
+            f"{_fmt(r['latency_p50_s'], '7.2f')} {_fmt(r['latency_p90_s'], '7.2f')} "
+            f"{_fmt(r['latency_p99_s'], '7.2f')} {_fmt(r['avg_output_tokens'], '8.0f')}"
+        )
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Replay recorded vision responses offline")
+    cli.add_argument("recordings", nargs="+", help="JSONL files written with RECORD_RESPONSES_PATH")
+    cli.add_argument("--by", default="prompt_version", choices=["prompt_version", "model", "prompt_kind"],
+                     help="how to group recordings for comparison")
+    args = cli.parse_args()
+
+    # Per-receipt mismatch warnings would drown the report
+    configure_logging(level="ERROR")
+
+    records = list(load_recordings(args.recordings))
+    start = time.perf_counter()
+    results = replay(records, by=args.by)
+    elapsed = time.perf_counter() - start
+
+    print_report(results)
+    print(f"\nreplayed {len(records)} recording(s) in {elapsed:.2f}s ({len(records) / elapsed:.0f}/s)"
+          if elapsed else "")
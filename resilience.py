@@ -0,0 +1,244 @@
+"""
+Protection around the Claude Vision call - an AIMD concurrency limiter and
+a circuit breaker, shared by every request in the process
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+import anthropic
+
+logger = logging.getLogger(__name__)
+
+
+class VisionUnavailableError(Exception):
+    """The vision API is overloaded or failing; the caller should retry later"""
+
+    def __init__(self, message: str, retry_after: float = 30.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(VisionUnavailableError):
+    """Raised without calling the API while the breaker is open"""
+
+
+def is_overload_error(error: Exception) -> bool:
+    """Errors that mean the upstream is struggling (vs. a bad request)"""
+    if isinstance(error, (anthropic.APITimeoutError, anthropic.APIConnectionError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 429) or error.status_code >= 500
+    return False
+
+
+# Seconds per output token are measured over at least this many tokens, so
+# short replies (dominated by time to first token) don't look slow per token
+MIN_RATE_TOKENS = 200
+
+# Weight of each fast call in the moving seconds-per-token baseline (~50-call window)
+BASELINE_ALPHA = 0.02
+
+
+class AdaptiveLimiter:
+    """
+    Additive-increase / multiplicative-decrease concurrency limit.
+    Each fast success adds 1/limit (about +1 per full window); a slow call
+    or an overload error multiplies the limit by `backoff`. A call is slow
+    when its seconds per output token exceed `latency_tolerance` times the
+    moving baseline, so long receipts are not mistaken for congestion;
+    `latency_target` is only an absolute ceiling.
+    """
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 32,
+                 latency_target: float = 120.0, latency_tolerance: float = 2.0,
+                 backoff: float = 0.5, queue_timeout: float = 60.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.last_latency = None
+        self.baseline: Optional[float] = None   # seconds per output token
+        self._cond = threading.Condition()
+
+    def acquire(self) -> bool:
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def adjust(self, limit: float, baseline: Optional[float], latency: float, overloaded: bool,
+               output_tokens: int = 0) -> Tuple[float, Optional[float]]:
+        """New (limit, baseline) after one call that took `latency` and produced `output_tokens`"""
+        slow = overloaded or latency > self.latency_target
+        if output_tokens and not overloaded:
+            rate = latency / max(output_tokens, MIN_RATE_TOKENS)
+            if baseline is None:
+                baseline = rate
+            else:
+                slow = slow or rate > baseline * self.latency_tolerance
+                # Slow calls move the baseline 10x slower, so congestion is not
+                # learned as normal while a lasting slowdown still is, eventually
+                baseline += BASELINE_ALPHA * (0.1 if slow else 1.0) * (rate - baseline)
+        if slow:
+            return max(self.min_limit, limit * self.backoff), baseline
+        return min(self.max_limit, limit + 1 / limit), baseline
+
+    def release(self, latency: float, overloaded: bool, output_tokens: int = 0):
+        with self._cond:
+            self.in_flight -= 1
+            self.last_latency = latency
+            self.limit, self.baseline = self.adjust(self.limit, self.baseline, latency, overloaded, output_tokens)
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+                "last_latency_s": self.last_latency,
+                "baseline_ms_per_token": round(self.baseline * 1000, 2) if self.baseline else None,
+            }
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive overload errors;
+    open -> half_open after `reset_timeout`, letting one trial call through;
+    half_open -> closed on success, back to open on failure.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, open_wait: float = 0.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.open_wait = open_wait  # > 0 queues callers instead of failing fast
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.short_circuited = 0
+        self._lock = threading.Lock()
+
+    def _retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self):
+        deadline = time.monotonic() + self.open_wait
+        while True:
+            with self._lock:
+                if self.state == "closed":
+                    return
+                if self.state == "open" and self._retry_after() <= 0:
+                    self.state = "half_open"
+                if self.state == "half_open" and not self.trial_in_flight:
+                    self.trial_in_flight = True
+                    return
+                retry_after = self._retry_after() or self.reset_timeout
+                if time.monotonic() >= deadline:
+                    self.short_circuited += 1
+                    raise CircuitOpenError("Vision API circuit is open", retry_after=retry_after)
+            time.sleep(min(1.0, retry_after, max(0.0, deadline - time.monotonic())))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("✅ Vision API circuit closed")
+            self.state = "closed"
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning("🔌 Vision API circuit opened after %d failure(s)", self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_neutral(self):
+        """Call finished with a non-overload error: release a half-open trial"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_after_s": round(self._retry_after(), 1) if self.state == "open" else 0,
+                "short_circuited": self.short_circuited,
+            }
+
+
+class VisionGuard:
+    """Limiter + breaker wrapped around every vision API call"""
+
+    def __init__(self, limiter: AdaptiveLimiter, breaker: CircuitBreaker):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.calls = 0
+        self.errors = 0
+
+    @contextmanager
+    def slot(self):
+        """
+        Admission for one call; raises VisionUnavailableError when shedding load.
+        Yields a dict where the caller puts the reply's "output_tokens".
+        """
+        self.breaker.before_call()
+        if not self.limiter.acquire():
+            self.breaker.record_neutral()
+            raise VisionUnavailableError("Too many receipts in flight, try again shortly", retry_after=5.0)
+
+        start = time.monotonic()
+        overloaded = False
+        call = {"output_tokens": 0}
+        try:
+            yield call
+        except Exception as e:
+            self.errors += 1
+            overloaded = is_overload_error(e)
+            if overloaded:
+                self.breaker.record_failure()
+                raise VisionUnavailableError(f"Vision API unavailable: {e}", retry_after=self.breaker.reset_timeout) from e
+            self.breaker.record_neutral()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self.calls += 1
+            self.limiter.release(time.monotonic() - start, overloaded, call["output_tokens"])
+
+    def call(self, fn: Callable, *args, **kwargs):
+        with self.slot():
+            return fn(*args, **kwargs)
+
+    def snapshot(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "limiter": self.limiter.snapshot(),
+            "breaker": self.breaker.snapshot(),
+        }
@@ -0,0 +1,320 @@
+"""
+Cross-process state for multi-worker deployments - one SQLite (WAL) file
+shared by every uvicorn worker on the host, holding the parsed-result cache,
+the vision API concurrency limit and the Google Sheets write buffer
+"""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+from resilience import AdaptiveLimiter
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS result_cache (
+    key        TEXT PRIMARY KEY,
+    value      TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS limiter (
+    name     TEXT PRIMARY KEY,
+    "limit"  REAL NOT NULL,
+    rejected INTEGER NOT NULL DEFAULT 0,
+    baseline REAL
+);
+
+CREATE TABLE IF NOT EXISTS limiter_leases (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    name        TEXT NOT NULL,
+    pid         INTEGER NOT NULL,
+    acquired_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sheet_outbox (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    receipt    TEXT NOT NULL,
+    written_at TEXT NOT NULL,
+    rows       TEXT NOT NULL,
+    claimed_by INTEGER,
+    claimed_at REAL
+);
+"""
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedState:
+    """SQLite connection shared by the threads of one worker; other workers open their own"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction holding the database lock across processes"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def query(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock on `path` + ".lock" across processes, for JSON caches
+    that every worker reads, merges into and rewrites
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_json_atomic(path: str, payload: Dict):
+    """Replace `path` with `payload` so readers never see a half-written file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as f:
+        json.dump(payload, f)
+    os.replace(f.name, path)
+
+
+_shared: Optional[SharedState] = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_state() -> Optional[SharedState]:
+    """The host-wide state database, or None unless SHARED_STATE=1"""
+    global _shared
+    if os.getenv("SHARED_STATE", "0") != "1":
+        return None
+    with _shared_lock:
+        if _shared is None:
+            path = os.getenv("SHARED_STATE_PATH") or os.path.join(tempfile.gettempdir(), "receipt_shared.db")
+            _shared = SharedState(path)
+            logger.info("🔗 Shared worker state at %s (pid %d)", path, os.getpid())
+        return _shared
+
+
+class ResultCache:
+    """Parsed receipts keyed by image hash, so a resubmitted image costs no API call"""
+
+    def __init__(self, shared: SharedState, ttl: float = 7 * 24 * 3600):
+        self.shared = shared
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict]:
+        rows = self.shared.query(
+            "SELECT value FROM result_cache WHERE key = ? AND created_at >= ?", (key, time.time() - self.ttl)
+        )
+        if not rows:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(rows[0][0])
+
+    def put(self, key: str, value: Dict):
+        with self.shared.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO result_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+            conn.execute("DELETE FROM result_cache WHERE created_at < ?", (time.time() - self.ttl,))
+
+    def snapshot(self) -> Dict:
+        entries = self.shared.query("SELECT COUNT(*) FROM result_cache")[0][0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+
+class SharedLimiter(AdaptiveLimiter):
+    """
+    AdaptiveLimiter whose limit and in-flight slots live in the shared
+    database, so N workers together stay within one AIMD window. Slots are
+    leases tagged with the worker pid; leases of dead workers are reclaimed.
+    """
+
+    def __init__(self, shared: SharedState, name: str = "vision", poll_interval: float = 0.1, **kwargs):
+        super().__init__(**kwargs)
+        self.shared = shared
+        self.name = name
+        self.poll_interval = poll_interval
+        self._pid = os.getpid()
+        with shared.transaction() as conn:
+            # State files written before the latency baseline existed
+            if "baseline" not in [row[1] for row in conn.execute("PRAGMA table_info(limiter)")]:
+                conn.execute("ALTER TABLE limiter ADD COLUMN baseline REAL")
+            conn.execute(
+                'INSERT OR IGNORE INTO limiter (name, "limit") VALUES (?, ?)', (name, self.limit)
+            )
+
+    def _reap(self, conn):
+        pids = [row[0] for row in conn.execute(
+            "SELECT DISTINCT pid FROM limiter_leases WHERE name = ?", (self.name,)
+        )]
+        dead = [pid for pid in pids if pid != self._pid and not _pid_alive(pid)]
+        if dead:
+            conn.executemany("DELETE FROM limiter_leases WHERE name = ? AND pid = ?", [(self.name, p) for p in dead])
+            logger.warning("🧹 Reclaimed vision slots of exited worker(s): %s", dead)
+
+    def _try_acquire(self) -> bool:
+        with self.shared.transaction() as conn:
+            self._reap(conn)
+            (limit,) = conn.execute('SELECT "limit" FROM limiter WHERE name = ?', (self.name,)).fetchone()
+            (in_flight,) = conn.execute("SELECT COUNT(*) FROM limiter_leases WHERE name = ?", (self.name,)).fetchone()
+            self.limit = limit
+            if in_flight >= int(limit):
+                return False
+            conn.execute(
+                "INSERT INTO limiter_leases (name, pid, acquired_at) VALUES (?, ?, ?)",
+                (self.name, self._pid, time.time()),
+            )
+            return True
+
+    def acquire(self) -> bool:
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            self.waiting += 1
+        try:
+            while not self._try_acquire():
+                if time.monotonic() >= deadline:
+                    with self.shared.transaction() as conn:
+                        conn.execute("UPDATE limiter SET rejected = rejected + 1 WHERE name = ?", (self.name,))
+                    return False
+                time.sleep(self.poll_interval)
+            with self._cond:
+                self.in_flight += 1
+            return True
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def release(self, latency: float, overloaded: bool, output_tokens: int = 0):
+        with self.shared.transaction() as conn:
+            conn.execute(
+                "DELETE FROM limiter_leases WHERE id ="
+                " (SELECT id FROM limiter_leases WHERE name = ? AND pid = ? LIMIT 1)",
+                (self.name, self._pid),
+            )
+            limit, baseline = conn.execute(
+                'SELECT "limit", baseline FROM limiter WHERE name = ?', (self.name,)
+            ).fetchone()
+            limit, baseline = self.adjust(limit, baseline, latency, overloaded, output_tokens)
+            conn.execute('UPDATE limiter SET "limit" = ?, baseline = ? WHERE name = ?', (limit, baseline, self.name))
+        with self._cond:
+            self.in_flight -= 1
+            self.last_latency = latency
+            self.limit = limit
+            self.baseline = baseline
+
+    def snapshot(self) -> Dict:
+        (limit, rejected, baseline), = self.shared.query(
+            'SELECT "limit", rejected, baseline FROM limiter WHERE name = ?', (self.name,)
+        )
+        (in_flight,), = self.shared.query("SELECT COUNT(*) FROM limiter_leases WHERE name = ?", (self.name,))
+        with self._cond:
+            return {
+                "limit": round(limit, 2),
+                "in_flight": in_flight,
+                "in_flight_this_worker": self.in_flight,
+                "waiting": self.waiting,
+                "rejected": rejected,
+                "last_latency_s": self.last_latency,
+                "baseline_ms_per_token": round(baseline * 1000, 2) if baseline else None,
+            }
+
+
+class SheetWriteBuffer:
+    """
+    Outbox of sheet rows shared by all workers. Any worker can flush it;
+    claimed batches are invisible to other flushers until completed, or
+    until `stale_after` seconds pass (the claiming worker died mid-write).
+    """
+
+    def __init__(self, shared: SharedState, stale_after: float = 120.0):
+        self.shared = shared
+        self.stale_after = stale_after
+
+    def enqueue(self, receipt: Dict, written_at: str, rows: List[list]) -> int:
+        with self.shared.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO sheet_outbox (receipt, written_at, rows) VALUES (?, ?, ?)",
+                (json.dumps(receipt), written_at, json.dumps(rows)),
+            )
+            return cursor.lastrowid
+
+    def claim(self, limit: int = 500) -> List[Tuple[int, Dict, str, List[list]]]:
+        """(id, receipt, written_at, rows) for up to `limit` pending entries, oldest first"""
+        now = time.time()
+        with self.shared.transaction() as conn:
+            entries = conn.execute(
+                "SELECT id, receipt, written_at, rows FROM sheet_outbox"
+                " WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY id LIMIT ?",
+                (now - self.stale_after, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE sheet_outbox SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                [(os.getpid(), now, entry[0]) for entry in entries],
+            )
+        return [(id_, json.loads(receipt), written_at, json.loads(rows)) for id_, receipt, written_at, rows in entries]
+
+    def complete(self, ids: List[int]):
+        with self.shared.transaction() as conn:
+            conn.executemany("DELETE FROM sheet_outbox WHERE id = ?", [(id_,) for id_ in ids])
+
+    def release(self, ids: List[int]):
+        """Hand claimed entries back after a failed write"""
+        with self.shared.transaction() as conn:
+            conn.executemany(
+                "UPDATE sheet_outbox SET claimed_by = NULL, claimed_at = NULL WHERE id = ?", [(id_,) for id_ in ids]
+            )
+
+    def is_pending(self, id_: int) -> bool:
+        """Whether an entry is still waiting to be written (queued or claimed by a flusher)"""
+        return bool(self.shared.query("SELECT 1 FROM sheet_outbox WHERE id = ?", (id_,)))
+
+    def snapshot(self) -> Dict:
+        (pending, claimed), = self.shared.query(
+            "SELECT COUNT(*), COUNT(claimed_by) FROM sheet_outbox"
+        )
+        return {"pending": pending - claimed, "in_flight": claimed}
@@ -0,0 +1,370 @@
+"""
+Store-template cache - guesses the merchant cheaply from the header band of
+the receipt and swaps the long generic prompt for a short store-specific
+one. The guess is only a candidate: a template result is used only when the
+store name the model read back confirms it. Layouts are learned from
+confirmed receipts and persisted as JSON.
+"""
+import copy
+import io
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from shared_state import file_lock, write_json_atomic
+
+try:
+    import easyocr
+except ImportError:
+    easyocr = None
+
+logger = logging.getLogger(__name__)
+
+# Fraction of the image height treated as the header (logo, store, address)
+HEADER_FRACTION = 0.18
+
+# Max differing bits (out of 64) for two header fingerprints to match
+FINGERPRINT_THRESHOLD = 10
+
+# The nearest store must beat every other store by this many bits. Text-only
+# headers hash within a few bits of each other, so ambiguous matches are dropped.
+FINGERPRINT_MARGIN = 4
+
+MAX_FINGERPRINTS_PER_STORE = 32
+
+KNOWN_STORES = {
+    "TARGET": {
+        "aliases": ["TARGET"],
+        "hints": [
+            "Item lines start with a 9-digit DPCI code; the name follows the code, do not include the code.",
+            "A letter flag after the price (T, N, NF) marks taxability and is not part of the price.",
+            "The transaction/receipt number is printed near the bottom with the register and store numbers.",
+        ],
+    },
+    "CVS PHARMACY": {
+        "aliases": ["CVS"],
+        "hints": [
+            "The receipt id follows 'TRN#' or 'TRANS'.",
+            "ExtraCare card and savings summary lines near the bottom are not items.",
+        ],
+    },
+    "TRADER JOE'S": {
+        "aliases": ["TRADER JOE"],
+        "hints": [
+            "Items have no codes; a quantity line like '2 @ $3.99' sits under the item it belongs to.",
+            "BAG FEE is category 'fee', usually with a '4 @ $0.10' line under it.",
+        ],
+    },
+    "WALMART": {
+        "aliases": ["WALMART", "WAL MART", "WAL-MART"],
+        "hints": [
+            "The receipt id is the 'TC#' number.",
+            "Item lines end with a 12-digit UPC, the price and a tax flag (N, X, O); use only the name and price.",
+        ],
+    },
+    "WHOLE FOODS MARKET": {
+        "aliases": ["WHOLE FOODS", "WFM"],
+        "hints": [
+            "'365WFM' is part of the product name.",
+            "CONTAINER DEPOSIT lines are category 'deposit'.",
+        ],
+    },
+}
+
+STORE_PROMPT = """
+You are an expert OCR system reading a receipt, most likely from {store}.
+Extract ALL information EXACTLY as printed - don't correct spelling, don't skip any item line.
+store_name: copy the store name printed in the header - do not assume {store}.
+
+{store} LAYOUT NOTES (apply only if this is a {store} receipt):
+{hints}
+
+RULES:
+- quantity: "5 @", "3 x", "QTY 2" or a number before the name; otherwise 1.
+  Sizes/weights (400G, 16OZ, 24PK, 2CT, 1.5LB) are NOT quantities.
+- Weighted lines "0.58 lb @ $1.99/lb": quantity = 1, line_total = the printed amount.
+- Every charge is an item with category "product", "tax", "fee" or "deposit"; include TAX even if $0.00.
+- Repeated identical lines are separate items.
+- Date as YYYY-MM-DD. Sum of all line_totals must equal total (within $0.10).
+
+Return ONLY valid JSON:
+{{"receipt_id": "...", "store_name": "...", "address": "street, city, state zip", "phone": "...",
+ "date": "YYYY-MM-DD", "time": "HH:MM:SS", "cashier": "...",
+ "items": [{{"name": "...", "quantity": 1, "unit_price": 0.00, "line_total": 0.00, "category": "product"}}],
+ "subtotal": 0.00, "total": 0.00, "payment_method": "...", "card_last_4": null}}
+"""
+
+
+def canonical_store_name(name: Optional[str]) -> Optional[str]:
+    """Map a printed store name onto a known store, else an upper-cased key"""
+    if not name:
+        return None
+    normalized = re.sub(r"[^A-Z0-9' ]+", " ", name.upper())
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    for store, profile in KNOWN_STORES.items():
+        if any(alias in normalized for alias in profile["aliases"]):
+            return store
+    return normalized or None
+
+
+def header_band(image_bytes: bytes) -> Image.Image:
+    """Grayscale top band of the receipt, decoded at reduced size where possible"""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("L", (image.width // 8, image.height // 8))  # JPEG: decode at 1/8 scale
+    image = image.convert("L")
+    return image.crop((0, 0, image.width, max(1, int(image.height * HEADER_FRACTION))))
+
+
+def fingerprint(band: Image.Image) -> int:
+    """64-bit difference hash of the header band"""
+    pixels = list(band.resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+class StoreTemplateCache:
+    """Per-store profiles (fingerprints + learned layout) and hit/latency stats"""
+
+    def __init__(self, path: Optional[str] = None, use_ocr: bool = False):
+        self.path = path
+        self.use_ocr = use_ocr and easyocr is not None
+        self.profiles: Dict[str, Dict] = {}
+        self.stats: Dict[str, Dict] = {}
+        self._reader = None
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    # ------------------------------------------------------------------
+    # Identification
+    # ------------------------------------------------------------------
+
+    def identify(self, image_bytes: bytes) -> Tuple[Optional[int], Optional[str]]:
+        """(header fingerprint, store) - store is None when nothing matches"""
+        try:
+            band = header_band(image_bytes)
+        except Exception as e:
+            logger.debug("Header band unavailable: %s", e)
+            return None, None
+
+        low, high = band.getextrema()
+        if high - low < 32:
+            # Blank/washed-out header: a fingerprint would match anything
+            return None, None
+
+        fp = fingerprint(band)
+        store = self._match_fingerprint(fp)
+        if self.use_ocr:
+            # Text beats the hash: OCR confirms or overrides a fingerprint match
+            store = self._match_ocr(band) or store
+        if store:
+            logger.info("🏪 Candidate store from header: %s", store)
+        return fp, store
+
+    def _nearest(self, fp: int, key: str = "fingerprints", exclude: Optional[str] = None) -> Dict[str, int]:
+        """Smallest distance to each store's `key` fingerprints ("fingerprints" or "rejected")"""
+        distances = {}
+        with self._lock:
+            for store, profile in self.profiles.items():
+                if store != exclude and profile.get(key):
+                    distances[store] = min((fp ^ known).bit_count() for known in profile[key])
+        return distances
+
+    def _match_fingerprint(self, fp: int) -> Optional[str]:
+        """
+        The store whose fingerprints are nearest, if within threshold and
+        unambiguous: every other store, and every header this store was
+        wrongly matched to before, must be FINGERPRINT_MARGIN bits further
+        """
+        ranked = sorted(self._nearest(fp).items(), key=lambda entry: entry[1])
+        if not ranked or ranked[0][1] > FINGERPRINT_THRESHOLD:
+            return None
+        store, distance = ranked[0]
+        competitors = [d for _, d in ranked[1:]]
+        if store in (rejected := self._nearest(fp, key="rejected")):
+            competitors.append(rejected[store])
+        if competitors and min(competitors) - distance < FINGERPRINT_MARGIN:
+            return None
+        return store
+
+    def confirmed(self, store: str, parsed: Optional[Dict]) -> bool:
+        """A template result counts only if the store name the model read back is `store`"""
+        return bool(parsed) and canonical_store_name(parsed.get("store_name")) == store
+
+    def learn_fingerprint(self, store: str, fp: int) -> bool:
+        """
+        Add a header fingerprint to a store's profile, unless it lies within
+        matching distance of another store (it would make both ambiguous)
+        """
+        if any(d <= FINGERPRINT_THRESHOLD + FINGERPRINT_MARGIN for d in self._nearest(fp, exclude=store).values()):
+            logger.debug("Fingerprint for %s is too close to another store, not learned", store)
+            return False
+        with self._lock:
+            profile = self.profiles.setdefault(store, {"fingerprints": [], "layout": {}})
+            if fp in profile["fingerprints"]:
+                return False
+            profile["fingerprints"] = (profile["fingerprints"] + [fp])[-MAX_FINGERPRINTS_PER_STORE:]
+        return True
+
+    def reject_fingerprint(self, store: str, fp: int) -> bool:
+        """Remember a header that matched `store` but belonged to another store"""
+        with self._lock:
+            profile = self.profiles.get(store)
+            if profile is None or fp in profile.setdefault("rejected", []):
+                return False
+            profile["rejected"] = (profile["rejected"] + [fp])[-MAX_FINGERPRINTS_PER_STORE:]
+        return True
+
+    def _match_ocr(self, band: Image.Image) -> Optional[str]:
+        import numpy as np
+
+        if self._reader is None:
+            self._reader = easyocr.Reader(["en"], gpu=False, verbose=False)
+        text = " ".join(self._reader.readtext(np.asarray(band), detail=0))
+        store = canonical_store_name(text)
+        if not store or store in KNOWN_STORES:
+            return store
+        with self._lock:
+            learned = [name for name in self.profiles if name in store]
+        return max(learned, key=len) if learned else None
+
+    # ------------------------------------------------------------------
+    # Prompts and learning
+    # ------------------------------------------------------------------
+
+    def build_prompt(self, store: str) -> str:
+        """Short prompt for a known store, including what earlier receipts showed"""
+        hints = list(KNOWN_STORES.get(store, {}).get("hints", []))
+        with self._lock:
+            layout = dict(self.profiles.get(store, {}).get("layout", {}))
+        if layout.get("weighted"):
+            hints.append("This store prints weighted produce lines (lb @ $/lb).")
+        if layout.get("fees"):
+            hints.append("This store charges bag fees or deposits - include them.")
+        if not hints:
+            hints.append("No special layout notes.")
+        return STORE_PROMPT.format(store=store, hints="\n".join(f"- {h}" for h in hints))
+
+    def observe(self, identified: Optional[str], fp: Optional[int], receipt, used_template: bool, latency: float):
+        """
+        Learn from a parsed receipt and record hit rate/latency for its store.
+        Nothing is learned from a receipt whose header matched a different
+        store; profiles are saved only when something a prompt uses changed.
+        """
+        store = canonical_store_name(receipt.store_name)
+        if not store:
+            return
+
+        changed = False
+        misidentified = identified is not None and identified != store
+        if misidentified and fp is not None:
+            changed = self.reject_fingerprint(identified, fp)
+        if receipt.items and not misidentified:
+            if fp is not None:
+                changed = self.learn_fingerprint(store, fp)
+            with self._lock:
+                profile = self.profiles.setdefault(store, {"fingerprints": [], "layout": {}})
+                layout = profile["layout"]
+                layout["receipts"] = layout.get("receipts", 0) + 1
+                layout["items"] = layout.get("items", 0) + len(receipt.items)
+                for flag, seen in (
+                    ("weighted", any(i.notes == "weighted" or "@" in i.name for i in receipt.items)),
+                    ("fees", any(i.category in ("fee", "deposit") for i in receipt.items)),
+                ):
+                    if seen and not layout.get(flag):
+                        layout[flag] = changed = True
+
+        with self._lock:
+            stats = self.stats.setdefault(store, {
+                "requests": 0, "hits": 0, "misidentified": 0, "fallbacks": 0,
+                "template_latency_s": 0.0, "template_calls": 0,
+                "generic_latency_s": 0.0, "generic_calls": 0,
+            })
+            stats["requests"] += 1
+            if identified == store:
+                stats["hits"] += 1
+                if not used_template:
+                    stats["fallbacks"] += 1
+            elif misidentified:
+                stats["misidentified"] += 1
+            kind = "template" if used_template else "generic"
+            stats[f"{kind}_latency_s"] += latency
+            stats[f"{kind}_calls"] += 1
+
+        if changed:
+            self._save()
+
+    def snapshot(self) -> Dict:
+        """Hit rate and average latency per store"""
+        with self._lock:
+            stores = {}
+            for store, s in self.stats.items():
+                stores[store] = {
+                    "requests": s["requests"],
+                    "hit_rate": round(s["hits"] / s["requests"], 3) if s["requests"] else 0.0,
+                    "misidentified": s["misidentified"],
+                    "fallbacks": s["fallbacks"],
+                    "avg_template_latency_s": round(s["template_latency_s"] / s["template_calls"], 2)
+                    if s["template_calls"] else None,
+                    "avg_generic_latency_s": round(s["generic_latency_s"] / s["generic_calls"], 2)
+                    if s["generic_calls"] else None,
+                }
+            return {"profiles": len(self.profiles), "ocr": self.use_ocr, "stores": stores}
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _read(self) -> Optional[Dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f).get("profiles", {})
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError, AttributeError) as e:
+            logger.warning("⚠️ Could not load store profiles from %s: %s", self.path, e)
+            return None
+
+    def _merge(self, profiles: Dict[str, Dict]):
+        """Fold saved profiles into ours: union of fingerprints, the larger counts, either flag"""
+        with self._lock:
+            for store, saved in profiles.items():
+                profile = self.profiles.setdefault(store, {"fingerprints": [], "layout": {}})
+                for key in ("fingerprints", "rejected"):
+                    known = profile.get(key, [])
+                    merged = known + [fp for fp in saved.get(key, []) if fp not in known]
+                    if merged:
+                        profile[key] = merged[-MAX_FINGERPRINTS_PER_STORE:]
+                layout = profile["layout"]
+                for name, value in saved.get("layout", {}).items():
+                    layout[name] = max(layout.get(name, value), value)
+
+    def _load(self):
+        profiles = self._read()
+        if profiles:
+            self._merge(profiles)
+            logger.info("🏪 Loaded %d store profile(s) from %s", len(self.profiles), self.path)
+
+    def _save(self):
+        """Merge what other workers saved since, then rewrite the file under a file lock"""
+        if not self.path:
+            return
+        try:
+            with file_lock(self.path):
+                profiles = self._read()
+                if profiles:
+                    self._merge(profiles)
+                with self._lock:
+                    payload = {"profiles": copy.deepcopy(self.profiles)}
+                write_json_atomic(self.path, payload)
+        except OSError as e:
+            logger.warning("⚠️ Could not save store profiles to %s: %s", self.path, e)
@@ -0,0 +1,124 @@
+"""
+Tiled parsing for long receipts - splits a tall image into overlapping
+horizontal tiles whose items are extracted concurrently, plus one small
+header/footer image for the receipt-level fields
+"""
+import io
+import re
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+# Receipts taller than this (height / width) are worth splitting
+MIN_ASPECT = 3.0
+
+# Each tile is this many widths tall, overlapping its neighbour by OVERLAP
+TILE_ASPECT = 1.5
+OVERLAP = 0.15
+
+# Longest run of items two neighbouring tiles can share
+MAX_OVERLAP_ITEMS = 10
+
+# The vision model downsizes anything with a longer edge than this anyway
+MAX_TILE_EDGE = 1568
+
+HEADER_FOOTER_PROMPT = """
+This image shows the TOP and the BOTTOM of one long store receipt, stacked.
+Do NOT list the purchased items. Extract only the receipt-level fields EXACTLY as printed:
+store name, full address, phone, receipt/transaction id (TRN#, TC#, etc.), date (as YYYY-MM-DD),
+time, cashier, subtotal, total, payment method and card last 4 digits.
+
+Return ONLY valid JSON:
+{"receipt_id": "...", "store_name": "...", "address": "street, city, state zip", "phone": "...",
+ "date": "YYYY-MM-DD", "time": "HH:MM:SS", "cashier": "...",
+ "subtotal": 0.00, "total": 0.00, "payment_method": "...", "card_last_4": null}
+"""
+
+TILE_ITEMS_PROMPT = """
+This image is one horizontal slice of a long store receipt.
+List EVERY charge line fully visible in this slice, EXACTLY as printed, top to bottom.
+Skip lines cut off at the top or bottom edge - the neighbouring slice contains them.
+Ignore headers, totals, subtotals and payment lines; DO include TAX, BAG FEE and DEPOSIT lines.
+
+- quantity: "5 @", "3 x", "QTY 2" or a number before the name; otherwise 1.
+  Sizes/weights (400G, 16OZ, 24PK, 2CT, 1.5LB) are NOT quantities.
+- category: "product", "tax", "fee" or "deposit".
+- Repeated identical lines are separate items.
+
+Return ONLY valid JSON:
+{"items": [{"name": "...", "quantity": 1, "unit_price": 0.00, "line_total": 0.00, "category": "product"}]}
+"""
+
+
+def should_tile(image: Image.Image) -> bool:
+    return image.width > 0 and image.height / image.width >= MIN_ASPECT
+
+
+def encode_jpeg(image: Image.Image, quality: int = 90, max_edge: int = MAX_TILE_EDGE) -> bytes:
+    if max(image.size) > max_edge:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def tile_boxes(width: int, height: int) -> List[Tuple[int, int, int, int]]:
+    """Crop boxes for overlapping tiles covering the whole height"""
+    tile_height = int(width * TILE_ASPECT)
+    if tile_height >= height:
+        return [(0, 0, width, height)]
+
+    step = tile_height - int(tile_height * OVERLAP)
+    boxes = []
+    top = 0
+    while True:
+        bottom = min(top + tile_height, height)
+        boxes.append((0, top, width, bottom))
+        if bottom >= height:
+            return boxes
+        top += step
+
+
+def split_receipt(image: Image.Image, max_edge: Optional[int] = None) -> Tuple[bytes, List[bytes]]:
+    """(header/footer image, item tiles) as JPEG bytes, each at most max_edge on its longest side"""
+    max_edge = min(max_edge or MAX_TILE_EDGE, MAX_TILE_EDGE)
+    width, height = image.size
+
+    header = image.crop((0, 0, width, min(int(height * 0.2), int(width * 0.8))))
+    footer = image.crop((0, height - min(int(height * 0.3), int(width * 1.2)), width, height))
+    stacked = Image.new("RGB", (width, header.height + footer.height), "white")
+    stacked.paste(header, (0, 0))
+    stacked.paste(footer, (0, header.height))
+
+    tiles = [encode_jpeg(image.crop(box), max_edge=max_edge) for box in tile_boxes(width, height)]
+    return encode_jpeg(stacked, max_edge=max_edge), tiles
+
+
+def _item_key(item: Dict) -> Tuple[str, str]:
+    name = re.sub(r"\s+", " ", str(item.get("name") or "")).strip().upper()
+    try:
+        total = f"{float(item.get('line_total') or 0):.2f}"
+    except (TypeError, ValueError):
+        total = str(item.get("line_total"))
+    return name, total
+
+
+def merge_tile_items(tiles: List[List[Dict]]) -> List[Dict]:
+    """
+    Concatenate per-tile items, dropping the run at the start of each tile
+    that repeats the end of the previous tile (the overlap band).
+    """
+    merged: List[Dict] = []
+    previous: List[Dict] = []
+    for items in tiles:
+        keys = [_item_key(i) for i in items]
+        prev_keys = [_item_key(i) for i in previous]
+        shared = 0
+        for k in range(min(len(prev_keys), len(keys), MAX_OVERLAP_ITEMS), 0, -1):
+            if prev_keys[-k:] == keys[:k]:
+                shared = k
+                break
+        merged.extend(items[shared:])
+        previous = items
+    return merged
@@ -0,0 +1,253 @@
+"""
+Token and cost accounting - usage of every parse (input, output and cached
+tokens, wall time, cost) aggregated per day and client in SQLite, plus a
+budget policy that downshifts max_tokens, image size and model tier as the
+daily budgets fill up
+"""
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# USD per million tokens: input, output, cache read, cache write (matched by prefix)
+MODEL_PRICES = {
+    "claude-sonnet-4": (3.00, 15.00, 0.30, 3.75),
+    "claude-haiku-4-5": (1.00, 5.00, 0.10, 1.25),
+    "claude-3-5-haiku": (0.80, 4.00, 0.08, 1.00),
+}
+DEFAULT_PRICES = MODEL_PRICES["claude-sonnet-4"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_daily (
+    date                  TEXT NOT NULL,
+    client                TEXT NOT NULL,
+    parses                INTEGER NOT NULL,
+    calls                 INTEGER NOT NULL,
+    input_tokens          INTEGER NOT NULL,
+    output_tokens         INTEGER NOT NULL,
+    cache_read_tokens     INTEGER NOT NULL,
+    cache_creation_tokens INTEGER NOT NULL,
+    wall_time_s           REAL NOT NULL,
+    cost_usd              REAL NOT NULL,
+    PRIMARY KEY (date, client)
+);
+"""
+
+COUNTERS = (
+    "parses", "calls", "input_tokens", "output_tokens", "cache_read_tokens",
+    "cache_creation_tokens", "wall_time_s", "cost_usd",
+)
+
+
+def price_for(model: str) -> Tuple[float, float, float, float]:
+    for prefix, prices in MODEL_PRICES.items():
+        if model.startswith(prefix):
+            return prices
+    return DEFAULT_PRICES
+
+
+class BudgetExceededError(Exception):
+    """The daily budget is spent; the caller should retry after `retry_after` seconds"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class ParsePlan:
+    """Request settings for one parse, chosen from the remaining budget"""
+    tier: str
+    model: str
+    max_tokens: int
+    max_edge: Optional[int]  # longest image edge sent; None keeps the full image
+
+
+class ParseUsage:
+    """Tokens, cost and time of one parse, which may span several (concurrent) vision calls"""
+
+    def __init__(self, client: str = "default", tier: str = "full"):
+        self.client = client
+        self.tier = tier
+        self.models = set()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_creation_tokens = 0
+        self.api_time_s = 0.0
+        self.wall_time_s = 0.0
+        self.cost_usd = 0.0
+        self.cached = False
+        self._lock = threading.Lock()
+
+    def add(self, model: str, message, latency: float):
+        usage = getattr(message, "usage", None)
+        tokens = [
+            getattr(usage, name, None) or 0
+            for name in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+        ]
+        prices = price_for(model)
+        cost = sum(count * price for count, price in zip(tokens, prices)) / 1_000_000
+        with self._lock:
+            self.models.add(model)
+            self.calls += 1
+            self.input_tokens += tokens[0]
+            self.output_tokens += tokens[1]
+            self.cache_read_tokens += tokens[2]
+            self.cache_creation_tokens += tokens[3]
+            self.api_time_s += latency
+            self.cost_usd += cost
+
+    def to_dict(self) -> Dict:
+        return {
+            "client": self.client,
+            "tier": self.tier,
+            "models": sorted(self.models),
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_creation_tokens": self.cache_creation_tokens,
+            "api_time_s": round(self.api_time_s, 3),
+            "wall_time_s": round(self.wall_time_s, 3),
+            "cost_usd": round(self.cost_usd, 6),
+            "cached": self.cached,
+        }
+
+
+class UsageLedger:
+    """Per-day, per-client usage totals; safe to share between threads and workers"""
+
+    def __init__(self, path: str = "usage.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def record(self, usage: ParseUsage):
+        values = usage.to_dict()
+        values["parses"] = 1
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    f"INSERT INTO usage_daily (date, client, {', '.join(COUNTERS)})"
+                    f" VALUES (?, ?, {', '.join('?' for _ in COUNTERS)})"
+                    " ON CONFLICT (date, client) DO UPDATE SET "
+                    + ", ".join(f"{c} = {c} + excluded.{c}" for c in COUNTERS),
+                    (date.today().isoformat(), usage.client, *(values[c] for c in COUNTERS)),
+                )
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Could not record usage in %s: %s", self.path, e)
+
+    def spent_today(self, client: Optional[str] = None) -> float:
+        sql = "SELECT COALESCE(SUM(cost_usd), 0) FROM usage_daily WHERE date = ?"
+        params = [date.today().isoformat()]
+        if client is not None:
+            sql += " AND client = ?"
+            params.append(client)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()[0]
+
+    def summary(self, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                client: Optional[str] = None) -> Dict:
+        """Totals plus per-day and per-client breakdowns for dashboards"""
+        clauses, params = [], []
+        for clause, value in (("date >= ?", date_from), ("date <= ?", date_to), ("client = ?", client)):
+            if value:
+                clauses.append(clause)
+                params.append(value)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        sums = ", ".join(f"SUM({c}) AS {c}" for c in COUNTERS)
+        with self._lock:
+            by_day = self._conn.execute(
+                f"SELECT date, {sums} FROM usage_daily{where} GROUP BY date ORDER BY date", params
+            ).fetchall()
+            by_client = self._conn.execute(
+                f"SELECT client, {sums} FROM usage_daily{where} GROUP BY client ORDER BY cost_usd DESC", params
+            ).fetchall()
+
+        def row_dict(row, key):
+            out = {key: row[key], **{c: row[c] for c in COUNTERS}}
+            out["cost_usd"] = round(out["cost_usd"], 4)
+            out["wall_time_s"] = round(out["wall_time_s"], 1)
+            out["avg_cost_usd"] = round(row["cost_usd"] / row["parses"], 5) if row["parses"] else None
+            return out
+
+        totals = {c: sum(row[c] for row in by_day) for c in COUNTERS}
+        totals["cost_usd"] = round(totals["cost_usd"], 4)
+        totals["wall_time_s"] = round(totals["wall_time_s"], 1)
+        return {
+            "totals": totals,
+            "by_day": [row_dict(row, "date") for row in by_day],
+            "by_client": [row_dict(row, "client") for row in by_client],
+        }
+
+
+class BudgetPolicy:
+    """
+    Picks a ParsePlan from today's spend. Below `downshift_at` of a budget
+    the full plan is used; then "economy" (fewer output tokens, smaller
+    image); past `minimal_at` the fallback model; at 100% requests are
+    refused when `hard_stop` is set. Budgets of 0 are unlimited.
+    """
+
+    def __init__(self, ledger: UsageLedger, model: str, fallback_model: str,
+                 daily_usd: float = 0.0, client_daily_usd: float = 0.0,
+                 downshift_at: float = 0.8, minimal_at: float = 0.95, hard_stop: bool = True):
+        self.ledger = ledger
+        self.daily_usd = daily_usd
+        self.client_daily_usd = client_daily_usd
+        self.downshift_at = downshift_at
+        self.minimal_at = minimal_at
+        self.hard_stop = hard_stop
+        # The API already scales images to a 1568 px long edge (~width*height/750 tokens),
+        # so only smaller edges cut input tokens: 1024 px is ~0.43x of that, 768 px ~0.24x
+        self.tiers = {
+            "full": ParsePlan("full", model, 8000, None),
+            "economy": ParsePlan("economy", model, 4000, 1024),
+            "minimal": ParsePlan("minimal", fallback_model, 2500, 768),
+        }
+
+    def used_fraction(self, client: str) -> float:
+        fractions = [0.0]
+        if self.daily_usd > 0:
+            fractions.append(self.ledger.spent_today() / self.daily_usd)
+        if self.client_daily_usd > 0:
+            fractions.append(self.ledger.spent_today(client) / self.client_daily_usd)
+        return max(fractions)
+
+    def plan(self, client: str = "default") -> ParsePlan:
+        used = self.used_fraction(client)
+        if used >= 1.0 and self.hard_stop:
+            midnight = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+            raise BudgetExceededError(
+                f"Daily vision budget exhausted for client '{client}'",
+                retry_after=(midnight - datetime.now()).total_seconds(),
+            )
+        if used >= self.minimal_at:
+            tier = "minimal"
+        elif used >= self.downshift_at:
+            tier = "economy"
+        else:
+            tier = "full"
+        if tier != "full":
+            logger.info("💸 Budget %.0f%% used, parsing in %s tier", used * 100, tier, extra={"client": client})
+        return self.tiers[tier]
+
+    def snapshot(self) -> Dict:
+        spent = self.ledger.spent_today()
+        return {
+            "daily_usd": self.daily_usd or None,
+            "client_daily_usd": self.client_daily_usd or None,
+            "spent_today_usd": round(spent, 4),
+            "used_fraction": round(spent / self.daily_usd, 3) if self.daily_usd else None,
+            "tiers": {name: vars(plan) for name, plan in self.tiers.items()},
+        }
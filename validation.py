@@ -0,0 +1,223 @@
+"""
+Vectorized validation - builds line items into integer-cent arrays and
+reconciles many receipts at once
+"""
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+CATEGORIES = ("product", "tax", "fee", "deposit", "other")
+CATEGORY_CODES = {name: code for code, name in enumerate(CATEGORIES)}
+OTHER_CODE = CATEGORY_CODES["other"]
+
+# Categories that make up the pre-tax subtotal
+SUBTOTAL_CODES = [CATEGORY_CODES["product"], CATEGORY_CODES["fee"], CATEGORY_CODES["deposit"]]
+
+# Sum of line totals must match the receipt total within $0.10
+MISMATCH_TOLERANCE_CENTS = 10
+
+
+@dataclass
+class ItemBatch:
+    """Flat arrays holding every valid line item of a batch of receipts"""
+    receipt_index: np.ndarray   # int64, which receipt the item belongs to
+    quantity: np.ndarray        # float64, quantity as read from the receipt
+    unit_cents: np.ndarray      # int64, 0 when missing (until back-filled)
+    total_cents: np.ndarray     # int64
+    category: np.ndarray        # int8, index into CATEGORIES
+    receipt_total_cents: np.ndarray  # int64, one per receipt
+    items: List[Dict]           # the item dicts, aligned with the arrays
+    per_receipt: List[List[Dict]]
+    receipts: List[Dict]
+
+
+@dataclass
+class Reconciliation:
+    """Per-receipt results of reconcile_batch"""
+    category_cents: np.ndarray  # (n_receipts, len(CATEGORIES))
+    category_counts: np.ndarray  # (n_receipts, len(CATEGORIES))
+    items_cents: np.ndarray     # sum of all line totals
+    subtotal_cents: np.ndarray  # products + fees + deposits
+    total_cents: np.ndarray     # total printed on the receipt
+    mismatch: np.ndarray        # bool
+
+    def breakdown(self, idx: int) -> Dict:
+        """Category totals for one receipt, in dollars"""
+        return breakdown(self.category_cents[idx].tolist(), self.category_counts[idx].tolist(),
+                         int(self.total_cents[idx]))
+
+
+def breakdown(category_cents: Sequence[int], category_counts: Sequence[int], total_cents: int) -> Dict:
+    """Category totals in dollars from per-category cents and counts"""
+    product, tax, fee, deposit = (CATEGORY_CODES[name] for name in ("product", "tax", "fee", "deposit"))
+    items_cents = sum(category_cents)
+    return {
+        "products": category_cents[product] / 100,
+        "product_count": category_counts[product],
+        "fees": (category_cents[fee] + category_cents[deposit]) / 100,
+        "fee_count": category_counts[fee] + category_counts[deposit],
+        "tax": category_cents[tax] / 100,
+        "tax_count": category_counts[tax],
+        "items_total": items_cents / 100,
+        "receipt_total": total_cents / 100,
+        "difference": abs(items_cents - total_cents) / 100,
+        "mismatch": abs(items_cents - total_cents) > MISMATCH_TOLERANCE_CENTS,
+    }
+
+
+def to_number(value, default: float = 0.0) -> float:
+    """A finite float from a number or numeric string; `default` for anything else ("two", "", None)"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return default
+    return number if math.isfinite(number) else default
+
+
+def to_floats(values: List, default: float = 0.0) -> np.ndarray:
+    """Float array of `values`; unparseable, missing or non-finite entries become `default`"""
+    try:
+        array = np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        # One bad value must not fail the batch: coerce item by item
+        return np.asarray([to_number(value, default) for value in values], dtype=np.float64)
+    finite = np.isfinite(array)  # None comes through as NaN
+    return array if finite.all() else np.where(finite, array, default)
+
+
+def to_cents(values: List) -> np.ndarray:
+    """Convert dollar amounts (numbers or numeric strings) to integer cents"""
+    return np.rint(to_floats(values) * 100).astype(np.int64)
+
+
+def build_item_batch(receipts: List[Dict]) -> ItemBatch:
+    """Flatten the valid items of all receipts into columnar arrays"""
+    per_receipt = [[item for item in data.get("items") or [] if item.get("name")] for data in receipts]
+    items = [item for kept in per_receipt for item in kept]
+    codes = CATEGORY_CODES
+
+    return ItemBatch(
+        receipt_index=np.repeat(np.arange(len(receipts), dtype=np.int64), [len(kept) for kept in per_receipt]),
+        quantity=to_floats([item.get("quantity") for item in items], default=1.0),
+        unit_cents=to_cents([item.get("unit_price") or 0 for item in items]),
+        total_cents=to_cents([item.get("line_total") or 0 for item in items]),
+        category=np.asarray([codes.get(item.get("category") or "product", OTHER_CODE) for item in items], dtype=np.int8),
+        receipt_total_cents=to_cents([data.get("total") or 0 for data in receipts]),
+        items=items,
+        per_receipt=per_receipt,
+        receipts=receipts,
+    )
+
+
+def backfill_unit_prices(batch: ItemBatch) -> np.ndarray:
+    """Fill missing unit prices with line_total / quantity (in cents)"""
+    missing = batch.unit_cents == 0
+    qty = batch.quantity
+    per_unit = np.divide(batch.total_cents, qty, out=batch.total_cents.astype(np.float64), where=qty > 0)
+    return np.where(missing, np.rint(per_unit).astype(np.int64), batch.unit_cents)
+
+
+def reconcile_batch(batch: ItemBatch) -> Reconciliation:
+    """Category totals and total-mismatch detection for every receipt at once"""
+    n_receipts = len(batch.receipt_total_cents)
+    n_cats = len(CATEGORIES)
+    bins = batch.receipt_index * n_cats + batch.category
+
+    category_cents = np.zeros(n_receipts * n_cats, dtype=np.int64)
+    np.add.at(category_cents, bins, batch.total_cents)
+    category_cents = category_cents.reshape(n_receipts, n_cats)
+    category_counts = np.bincount(bins, minlength=n_receipts * n_cats).reshape(n_receipts, n_cats)
+
+    items_cents = category_cents.sum(axis=1)
+    subtotal_cents = category_cents[:, SUBTOTAL_CODES].sum(axis=1)
+    mismatch = np.abs(items_cents - batch.receipt_total_cents) > MISMATCH_TOLERANCE_CENTS
+
+    return Reconciliation(
+        category_cents=category_cents,
+        category_counts=category_counts,
+        items_cents=items_cents,
+        subtotal_cents=subtotal_cents,
+        total_cents=batch.receipt_total_cents,
+        mismatch=mismatch,
+    )
+
+
+def apply_batch(batch: ItemBatch, unit_cents: np.ndarray):
+    """Write normalized values back into the item dicts"""
+    for item, qty, unit, total, cat in zip(
+        batch.items,
+        batch.quantity.tolist(),
+        unit_cents.tolist(),
+        batch.total_cents.tolist(),
+        batch.category.tolist(),
+    ):
+        item["quantity"] = int(qty)
+        item["unit_price"] = unit / 100
+        item["line_total"] = total / 100
+        if cat != OTHER_CODE:
+            item["category"] = CATEGORIES[cat]
+
+    for data, kept in zip(batch.receipts, batch.per_receipt):
+        data["items"] = kept
+        data["item_count"] = len(kept)
+
+
+def validate_receipt(data: Dict) -> Dict:
+    """
+    Validate, back-fill and reconcile ONE receipt in place and return its
+    breakdown. A plain loop: for a single receipt building arrays costs
+    more than it saves, so the per-request path stays here. Money is
+    handled in integer cents exactly as validate_batch does, so both give
+    the same values and the same mismatch verdict.
+    """
+    kept = []
+    category_cents = [0] * len(CATEGORIES)
+    category_counts = [0] * len(CATEGORIES)
+    for item in data.get("items") or []:
+        if not item.get("name"):
+            continue
+        # Inline fast paths for the usual int/float values; `x - x` is NaN (truthy) for NaN and inf
+        quantity = item.get("quantity")
+        if type(quantity) is not int:
+            quantity = to_number(quantity, 1.0)
+        total = item.get("line_total")
+        if type(total) is not float or total - total:
+            total = to_number(total)
+        unit = item.get("unit_price")
+        if type(unit) is not float or unit - unit:
+            unit = to_number(unit)
+        # round() rounds half to even like np.rint in to_cents
+        total = round(total * 100)
+        unit = round(unit * 100)
+        if not unit:
+            unit = round(total / quantity) if quantity > 0 else total
+        code = CATEGORY_CODES.get(item.get("category") or "product", OTHER_CODE)
+
+        item["quantity"] = int(quantity)
+        item["unit_price"] = unit / 100
+        item["line_total"] = total / 100
+        if code != OTHER_CODE:
+            item["category"] = CATEGORIES[code]
+        category_cents[code] += total
+        category_counts[code] += 1
+        kept.append(item)
+
+    data["items"] = kept
+    data["item_count"] = len(kept)
+    return breakdown(category_cents, category_counts, round(to_number(data.get("total")) * 100))
+
+
+def validate_batch(receipts: List[Dict]) -> Tuple[ItemBatch, Reconciliation]:
+    """Validate, back-fill and reconcile many receipts without touching the dicts"""
+    batch = build_item_batch(receipts)
+    batch.unit_cents = backfill_unit_prices(batch)
+    return batch, reconcile_batch(batch)
+
+
+def validate_items(receipts: List[Dict]) -> Reconciliation:
+    """Validate, back-fill and reconcile the items of many receipts in place"""
+    batch, summary = validate_batch(receipts)
+    apply_batch(batch, batch.unit_cents)
+    return summary